@@ -7,26 +7,43 @@ from . import sale
 from . import purchase
 from . import recibo
 from . import account
+from . import analytic_account
+from . import currency
 from . import cashflow
 
 
 def register():
     Pool.register(
         sale.Sale,
+        sale.SaleLine,
         sale.UpdateSaleProjectionStart,
         purchase.Purchase,
+        purchase.PurchaseLine,
         purchase.UpdatePurchaseProjectionStart,
         recibo.Recibo,
         recibo.ReciboLote,
         recibo.UpdateReciboLoteProjectionStart,
+        recibo.UpdateReciboLoteProjectionPreview,
+        recibo.UpdateReciboLoteProjectionPreviewLote,
         account.Account,
+        account.Move,
+        account.MoveLine,
+        analytic_account.Account,
+        currency.Rate,
         cashflow.PrintCashFlowReportStart,
+        cashflow.CashFlowRequest,
+        cashflow.CashFlowRequestUser,
+        cashflow.CashFlowScenario,
+        cashflow.CashFlowSummary,
+        cashflow.CashFlowSummaryPending,
+        cashflow.RebuildCashFlowSummaryStart,
         module='cooperative_cashflow_ar', type_='model')
     Pool.register(
         sale.UpdateSaleProjection,
         purchase.UpdatePurchaseProjection,
         recibo.UpdateReciboLoteProjection,
         cashflow.PrintCashFlowReport,
+        cashflow.RebuildCashFlowSummary,
         module='cooperative_cashflow_ar', type_='wizard')
     Pool.register(
         cashflow.CashFlowReport,
@@ -1,16 +1,88 @@
 # This file is part of the cooperative_cashflow_ar module for Tryton.
 # The COPYRIGHT file at the top level of this repository contains
 # the full copyright notices and license terms.
+import datetime
+from sql import Literal
 
 from trytond.model import fields
-from trytond.pool import PoolMeta
+from trytond.pool import Pool, PoolMeta
 
 
 class Account(metaclass=PoolMeta):
     __name__ = 'account.account'
 
     cashflow_report = fields.Boolean('Use in cashflow report', select=True)
+    cashflow_balance = fields.Boolean('Cash in cashflow report', select=True,
+        help='The balance of the account is added to the opening cash '
+        'position of the cashflow report.')
+
+    @classmethod
+    def __register__(cls, module_name):
+        super().__register__(module_name)
+        table_h = cls.__table_handler__(module_name)
+        table = cls.__table__()
+        table_h.index_action(['id'], 'add',
+            where=table.cashflow_report == Literal(True))
+        table_h.index_action(['id'], 'add',
+            where=table.cashflow_balance == Literal(True))
 
     @staticmethod
     def default_cashflow_report():
         return False
+
+    @staticmethod
+    def default_cashflow_balance():
+        return False
+
+    @classmethod
+    def write(cls, *args):
+        pool = Pool()
+        Summary = pool.get('cooperative_ar.cashflow.summary')
+        Report = pool.get('cooperative_ar.cashflow', type='report')
+        actions = iter(args)
+        companies = set()
+        balance = False
+        for accounts, values in zip(actions, actions):
+            if 'cashflow_report' in values:
+                companies.update(a.company.id for a in accounts)
+            if 'cashflow_balance' in values:
+                balance = True
+        super().write(*args)
+        Summary.invalidate([('expense', company_id,
+                    datetime.date.min, datetime.date.max)
+                for company_id in companies])
+        if balance:
+            # The cached reports have the opening cash position
+            Report._cache.clear()
+
+
+class Move(metaclass=PoolMeta):
+    __name__ = 'account.move'
+
+    @classmethod
+    def __register__(cls, module_name):
+        super().__register__(module_name)
+        table = cls.__table_handler__(module_name)
+        table.index_action(['company', 'state', 'date'], 'add')
+
+    @classmethod
+    def post(cls, moves):
+        pool = Pool()
+        Summary = pool.get('cooperative_ar.cashflow.summary')
+        Report = pool.get('cooperative_ar.cashflow', type='report')
+        super().post(moves)
+        Summary.update('expense', [(m.company.id, m.date) for m in moves
+                if any(l.account.cashflow_report for l in m.lines)])
+        if any(l.account.cashflow_balance for m in moves for l in m.lines):
+            # The cached reports have the opening cash position
+            Report._cache.clear()
+
+
+class MoveLine(metaclass=PoolMeta):
+    __name__ = 'account.move.line'
+
+    @classmethod
+    def __register__(cls, module_name):
+        super().__register__(module_name)
+        table = cls.__table_handler__(module_name)
+        table.index_action(['account', 'move'], 'add')
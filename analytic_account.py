@@ -0,0 +1,22 @@
+# This file is part of the cooperative_cashflow_ar module for Tryton.
+# The COPYRIGHT file at the top level of this repository contains
+# the full copyright notices and license terms.
+import datetime
+
+from trytond.pool import Pool, PoolMeta
+
+
+class Account(metaclass=PoolMeta):
+    __name__ = 'analytic_account.account'
+
+    @classmethod
+    def create(cls, vlist):
+        pool = Pool()
+        Summary = pool.get('cooperative_ar.cashflow.summary')
+        accounts = super().create(vlist)
+        # The summaries of the categories are by root
+        Summary.invalidate([(source, a.company.id,
+                    datetime.date.min, datetime.date.max)
+                for a in accounts if a.type == 'root'
+                for source in Summary._get_root_sources()])
+        return accounts
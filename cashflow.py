@@ -1,18 +1,289 @@
 # This file is part of the cooperative_cashflow_ar module for Tryton.
 # The COPYRIGHT file at the top level of this repository contains
 # the full copyright notices and license terms.
+import csv
+import datetime
+import io
+import tempfile
+import uuid
+import zipfile
+from array import array
+from bisect import bisect_right
+from collections import defaultdict, namedtuple
+from concurrent.futures import ThreadPoolExecutor
 from decimal import Decimal
+from itertools import islice
 from dateutil.relativedelta import relativedelta
+from sql import Literal, Null, Union
+from sql.aggregate import Max, Sum
+from sql.conditionals import Case
+from sql.functions import Abs, CurrentTimestamp, DateTrunc, Round
+from sql.operators import Concat
 
-from trytond.model import ModelView, fields
-from trytond.wizard import Wizard, StateView, StateReport, Button
+from trytond import backend
+from trytond.bus import notify
+from trytond.cache import Cache
+from trytond.config import config
+from trytond.i18n import gettext
+from trytond.model import ModelView, ModelSQL, fields
+from trytond.model.exceptions import ValidationError
+from trytond.wizard import (Wizard, StateView, StateTransition, StateReport,
+    StateAction, Button)
 from trytond.report import Report
 from trytond.pool import Pool
-from trytond.pyson import Eval, If
+from trytond.pyson import Bool, Eval, If
+from trytond.tools import grouped_slice
 from trytond.transaction import Transaction
 
+from .formula import Formula, months_between
+from .profiler import Profiler, activate, current_profiler, phase
 
-MAX_COLS = 24
+
+def fetch_chunks(query, size=None):
+    """Execute the query and yield its rows fetched by chunks of size
+
+    On PostgreSQL the rows are kept by a server-side cursor because the
+    client-side cursors receive all the rows at the execution."""
+    if size is None:
+        size = config.getint('cashflow', 'chunk', default=1000)
+    connection = Transaction().connection
+    if backend.name == 'postgresql':
+        cursor = connection.cursor('cashflow_%s' % uuid.uuid4().hex)
+    else:
+        cursor = connection.cursor()
+    profiler = current_profiler()
+    try:
+        cursor.execute(*query)
+        while True:
+            rows = cursor.fetchmany(size)
+            if not rows:
+                break
+            if profiler:
+                profiler.add(rows=len(rows))
+            yield from rows
+    finally:
+        cursor.close()
+
+
+class RateTable(object):
+    """Currency rates of a period loaded at once and indexed by date
+
+    It gives the same results as currency.currency compute but without
+    querying the rates for each conversion."""
+
+    def __init__(self, from_date, to_date):
+        pool = Pool()
+        Rate = pool.get('currency.currency.rate')
+        rate = Rate.__table__()
+        previous_rate = Rate.__table__()
+        cursor = Transaction().connection.cursor()
+
+        self._currencies = {}
+        self._dates = defaultdict(list)
+        self._rates = defaultdict(list)
+
+        # The last rate before the period is still the one in use at
+        # its beginning
+        previous = previous_rate.select(Max(previous_rate.date),
+            where=((previous_rate.currency == rate.currency)
+                & (previous_rate.date < from_date)))
+        cursor.execute(*rate.select(rate.currency, rate.date, rate.rate,
+                where=((rate.date <= to_date)
+                    & ((rate.date >= from_date) | (rate.date == previous))),
+                order_by=[rate.currency.asc, rate.date.asc]))
+        for currency_id, date, value in cursor:
+            self._dates[currency_id].append(date)
+            self._rates[currency_id].append(Decimal(str(value)))
+
+    def currency(self, currency_id):
+        pool = Pool()
+        Currency = pool.get('currency.currency')
+        if currency_id not in self._currencies:
+            self._currencies[currency_id] = Currency(currency_id)
+        return self._currencies[currency_id]
+
+    def rate(self, currency_id, date):
+        idx = bisect_right(self._dates[currency_id], date)
+        if idx:
+            return self._rates[currency_id][idx - 1]
+
+    def compute(self, from_currency, amount, to_currency, date):
+        pool = Pool()
+        Currency = pool.get('currency.currency')
+        from_currency, to_currency = int(from_currency), int(to_currency)
+
+        if from_currency == to_currency:
+            return self.currency(to_currency).round(amount)
+        from_rate = self.rate(from_currency, date)
+        to_rate = self.rate(to_currency, date)
+        if not from_rate or not to_rate:
+            # Let currency raise its own error
+            with Transaction().set_context(date=date):
+                return Currency.compute(from_currency, amount, to_currency)
+        return self.currency(to_currency).round(
+            amount * to_rate / from_rate)
+
+
+CashFlowSource = namedtuple('CashFlowSource',
+    ['name', 'label', 'sign', 'row', 'section'])
+CashFlowSource.__doc__ = """A source of the cash-flow report
+
+name: the source name, its amounts are fetched by _fetch_<name>
+label: the name of its line in the synthesis
+sign: 1 for inflows and -1 for outflows
+row: the detail field used as row of the summary, category or partner
+section: the prefix of its raw and summary sections in the report"""
+
+
+class Pivot(object):
+    """Pivot the amounts of the sources by row and date column
+
+    The amounts are accumulated as integers of the smallest unit of the
+    currency and the synthesis of the sources is computed in the same
+    pass."""
+
+    def __init__(self, columns, digits):
+        self.columns = columns
+        self.size = len(columns) + 1
+        self.digits = digits
+        self.scale = 10 ** digits
+        self.labels = {}
+        self.signs = {}
+        self.names = {}
+        self.groups = {}
+        self.scenarios = {}
+        self.opening = None
+        self.balance_labels = ()
+        self._rows = {}
+
+    def add_source(self, source, label, sign):
+        self.labels[source] = label
+        self.signs[source] = sign
+        self.names[source] = {}
+
+    def add_group(self, group, label):
+        "Add a result row for the amounts added with the group"
+        self.groups[group] = label
+
+    def add_scenario(self, scenario, label):
+        "Add a result row with the adjustments of the scenario"
+        self.scenarios[scenario] = label
+
+    def set_opening(self, amount, label, balance_label, minimum_label):
+        """Add the rows of the cash position at the start of each column,
+        the running balance and the minimum balance from the opening amount"""
+        self.opening = int((amount * self.scale).to_integral_value())
+        self.balance_labels = (label, balance_label, minimum_label)
+
+    def adjust(self, scenario, source, date, amount):
+        "Add to the result of the scenario the amount of the source"
+        if date not in self.columns:
+            return
+        row, filled = self._row((None, None, scenario))
+        value = int((amount * self.scale).to_integral_value())
+        for idx in [self.columns[date]['idx'], self.size - 1]:
+            row[idx] += self.signs[source] * value
+            filled[idx] = 1
+
+    def _row(self, key):
+        if key not in self._rows:
+            filled = bytearray(self.size)
+            filled[-1] = 1
+            self._rows[key] = (array('q', bytes(8 * self.size)), filled)
+        return self._rows[key]
+
+    def add(self, source, key, name, date, amount, group=None):
+        names = self.names[source]
+        if key not in names:
+            names[key] = name
+        rows = [
+            (self._row((source, key)), 1),
+            (self._row((source,)), 1),
+            (self._row(()), self.signs[source]),
+            ]
+        if group in self.groups:
+            rows.append((self._row((None, group)), self.signs[source]))
+        if date not in self.columns:
+            return
+        value = int((amount * self.scale).to_integral_value())
+        for (row, filled), sign in rows:
+            for idx in [self.columns[date]['idx'], self.size - 1]:
+                row[idx] += sign * value
+                filled[idx] = 1
+
+    def merge(self, pivot):
+        "Add the rows of the pivot of the same columns"
+        for source, names in pivot.names.items():
+            for key, name in names.items():
+                self.names[source].setdefault(key, name)
+        for key, (values, filled) in pivot._rows.items():
+            row, row_filled = self._row(key)
+            for idx in range(self.size):
+                row[idx] += values[idx]
+                row_filled[idx] |= filled[idx]
+
+    def values(self, key):
+        if key not in self._rows:
+            return [None] * self.size
+        row, filled = self._rows[key]
+        return [Decimal(v).scaleb(-self.digits) if f else None
+            for v, f in zip(row, filled)]
+
+    def summary(self, source, field):
+        records = []
+        for key, name in self.names[source].items():
+            values = self.values((source, key))
+            records.append({
+                    field: name,
+                    'columns': values,
+                    'total': values[-1],
+                    })
+        return records
+
+    def synthesis(self, label):
+        records = [{
+                'name': self.labels[source],
+                'columns': self.values((source,)),
+                } for source in self.names]
+        records.extend({
+                'name': label,
+                'columns': self.values((None, group)),
+                } for group, label in self.groups.items())
+        records.append({
+                'name': label,
+                'columns': self.values(()),
+                })
+        result, result_filled = self._row(())
+        if self.opening is not None:
+            # the total column is the opening, the final and the minimum
+            openings, balances, minimums = [], [], []
+            balance = minimum = self.opening
+            for value in result[:-1]:
+                openings.append(balance)
+                balance += value
+                minimum = min(minimum, balance)
+                balances.append(balance)
+                minimums.append(minimum)
+            openings.append(self.opening)
+            balances.append(balance)
+            minimums.append(minimum)
+            records.extend({
+                    'name': label,
+                    'columns': [Decimal(v).scaleb(-self.digits)
+                        for v in values],
+                    } for label, values in zip(self.balance_labels,
+                    [openings, balances, minimums]))
+        for scenario, label in self.scenarios.items():
+            row, filled = self._row((None, None, scenario))
+            records.append({
+                    'name': label,
+                    'columns': [
+                        Decimal(r + v).scaleb(-self.digits) if f or g
+                        else None
+                        for r, v, f, g in zip(
+                            result, row, result_filled, filled)],
+                    })
+        return records
 
 
 class PrintCashFlowReportStart(ModelView):
@@ -21,12 +292,42 @@ class PrintCashFlowReportStart(ModelView):
 
     company = fields.Many2One('company.company', 'Company', required=True)
     analytic_account = fields.Many2One('analytic_account.account',
-        'Analytic Account', required=True,
+        'Analytic Account',
         domain=[
             ('company', '=', Eval('company', -1)),
             ('type', '=', 'root'),
             ],
-        depends=['company'])
+        states={
+            'required': ~Eval('consolidated', False),
+            'invisible': Eval('consolidated', False),
+            },
+        depends=['company', 'consolidated'])
+    scenarios = fields.Many2Many('cooperative_ar.cashflow.scenario',
+        None, None, 'Scenarios',
+        help='Add to the synthesis the result of the scenarios.')
+    consolidated = fields.Boolean('Consolidated',
+        help='Report the amounts of many companies together.')
+    companies = fields.Many2Many('company.company', None, None, 'Companies',
+        states={
+            'required': Eval('consolidated', False),
+            'invisible': ~Eval('consolidated', False),
+            },
+        depends=['consolidated'])
+    analytic_accounts = fields.Many2Many('analytic_account.account',
+        None, None, 'Analytic Accounts',
+        domain=[
+            ('company', 'in', Eval('companies', [])),
+            ('type', '=', 'root'),
+            ],
+        states={
+            'required': Eval('consolidated', False),
+            'invisible': ~Eval('consolidated', False),
+            },
+        depends=['companies', 'consolidated'],
+        help='The analytic roots of the companies.\n'
+        'The categories with the same name are summed.')
+    currency = fields.Many2One('currency.currency', 'Currency',
+        required=True, help='The currency in which the amounts are reported.')
     from_date = fields.Date('From Date', required=True,
         domain=[
             If(Eval('to_date') & Eval('from_date'),
@@ -41,11 +342,97 @@ class PrintCashFlowReportStart(ModelView):
                 ()),
             ],
         depends=['from_date'])
+    granularity = fields.Selection([
+            ('day', 'Day'),
+            ('week', 'Week'),
+            ('month', 'Month'),
+            ('quarter', 'Quarter'),
+            ], 'Granularity', required=True,
+        help='The period of the columns.')
+    use_summary = fields.Boolean('Use Summary',
+        states={
+            'invisible': ~Eval('granularity').in_(['month', 'quarter']),
+            },
+        depends=['granularity'],
+        help='Read the amounts from the cash-flow summary table instead of '
+        'the documents.\nThe amounts are taken by whole months.')
+    format = fields.Selection([
+            ('ods', 'ODS'),
+            ('csv', 'CSV'),
+            ], 'Format', required=True,
+        help='CSV writes the sections as files of a zip archive without '
+        'rendering the template.')
+    enqueue = fields.Boolean('Enqueue',
+        states={
+            'invisible': (Eval('consolidated', False)
+                | Bool(Eval('scenarios', []))),
+            },
+        depends=['consolidated', 'scenarios'],
+        help='Generate the report in background and notify when it is '
+        'ready.')
+    details = fields.Boolean('Details',
+        help='Add the sheets of the detail records of each source.')
+    details_limit = fields.Integer('Details Limit',
+        domain=[
+            If(Bool(Eval('details_limit')),
+                ('details_limit', '>', 0),
+                ()),
+            ],
+        states={
+            'invisible': ~Eval('details', False),
+            },
+        depends=['details'],
+        help='The maximum number of records of each detail sheet.\n'
+        'Leave empty for all the records.')
+    profile = fields.Boolean('Profile',
+        help='Add a hidden sheet with the time, the SQL queries and the '
+        'rows fetched by each phase of the report.')
 
     @classmethod
     def default_company(cls):
         return Transaction().context.get('company')
 
+    @staticmethod
+    def default_consolidated():
+        return False
+
+    @classmethod
+    def default_currency(cls):
+        pool = Pool()
+        Company = pool.get('company.company')
+        company_id = cls.default_company()
+        if company_id:
+            return Company(company_id).currency.id
+
+    @fields.depends('company', 'currency')
+    def on_change_company(self):
+        if self.company and not self.currency:
+            self.currency = self.company.currency
+
+    @staticmethod
+    def default_granularity():
+        return 'month'
+
+    @staticmethod
+    def default_use_summary():
+        return False
+
+    @staticmethod
+    def default_format():
+        return 'ods'
+
+    @staticmethod
+    def default_enqueue():
+        return False
+
+    @staticmethod
+    def default_details():
+        return True
+
+    @staticmethod
+    def default_profile():
+        return False
+
 
 class PrintCashFlowReport(Wizard):
     'Print Cash-Flow'
@@ -54,346 +441,1366 @@ class PrintCashFlowReport(Wizard):
     start = StateView('cooperative_ar.print_cashflow.start',
         'cooperative_cashflow_ar.print_cashflow_report_start_view', [
             Button('Cancel', 'end', 'tryton-cancel'),
-            Button('Print', 'print_', 'tryton-print', True),
+            Button('Print', 'choose', 'tryton-print', True),
             ])
+    choose = StateTransition()
     print_ = StateReport('cooperative_ar.cashflow')
+    enqueue = StateAction('cooperative_cashflow_ar.act_cashflow_request')
 
-    def do_print_(self, action):
+    def get_data(self):
         data = {
             'company': self.start.company.id,
-            'analytic_account': self.start.analytic_account.id,
+            'currency': self.start.currency.id,
             'from_date': self.start.from_date,
             'to_date': self.start.to_date,
+            'granularity': self.start.granularity,
+            # the summaries are by month
+            'use_summary': (self.start.use_summary
+                and self.start.granularity in {'month', 'quarter'}),
+            'format': self.start.format,
+            'scenarios': [s.id for s in self.start.scenarios],
+            'details': self.start.details,
+            'details_limit': (self.start.details_limit
+                if self.start.details else None),
+            'profile': self.start.profile,
             }
-        return action, data
+        if self.start.consolidated:
+            data['analytic_account'] = None
+            data['companies'] = [c.id for c in self.start.companies]
+            data['analytic_accounts'] = [
+                a.id for a in self.start.analytic_accounts]
+        else:
+            data['analytic_account'] = self.start.analytic_account.id
+        return data
+
+    def transition_choose(self):
+        # the requests store only one company and no scenario
+        if (self.start.enqueue and not self.start.consolidated
+                and not self.start.scenarios):
+            return 'enqueue'
+        return 'print_'
+
+    def do_print_(self, action):
+        return action, self.get_data()
+
+    def do_enqueue(self, action):
+        pool = Pool()
+        Request = pool.get('cooperative_ar.cashflow.request')
+        request = Request.get_request(self.get_data())
+        return action, {'res_id': [request.id]}
 
 
 class CashFlowReport(Report):
     'Cash-Flow'
     __name__ = 'cooperative_ar.cashflow'
+    _cache = Cache('cooperative_ar.cashflow', size_limit=32,
+        duration=datetime.timedelta(hours=1))
 
     @classmethod
     def get_context(cls, records, header, data):
         pool = Pool()
         Company = pool.get('company.company')
 
-        report_context = super().get_context(records, header, data)
+        with phase('get_context'):
+            report_context = super().get_context(records, header, data)
+
+            report_context['company'] = Company(data['company'])
+            report_context['from_date'] = data['from_date']
+            report_context['to_date'] = data['to_date']
+
+            columns = cls._get_date_columns(
+                data['from_date'], data['to_date'],
+                data.get('granularity', 'month'))
+            report_context['columns'] = [x['lbl']
+                for x in columns.values()] + ['Total']
+
+            report_context.update(cls._get_cached_sections(data, columns))
+            report_context['details'] = bool(data.get('details', True))
+            # the details are never cached
+            report_context.update(cls._get_detail_sections(data))
+
+        # the phases of the rendering are only logged
+        profiler = current_profiler()
+        report_context['profile'] = (list(profiler.phases)
+            if profiler and data.get('profile') else [])
+        return report_context
+
+    @classmethod
+    def _execute(cls, records, header, data, action):
+        profiler = Profiler() if cls._get_profile(data) else None
+        with activate(profiler):
+            if data.get('format') == 'csv':
+                with phase('render'):
+                    return 'zip', cls._render_csv(data)
+            return super()._execute(records, header, data, action)
+
+    @staticmethod
+    def _get_profile(data):
+        "Return if the phases of the report must be measured"
+        return bool(data.get('profile')
+            or config.getboolean('cashflow', 'profile', default=False))
+
+    @classmethod
+    def render(cls, report, report_context):
+        with phase('render'):
+            return super().render(report, report_context)
+
+    @classmethod
+    def convert(cls, report, data, **kwargs):
+        with phase('convert'):
+            return super().convert(report, data, **kwargs)
+
+    @classmethod
+    def _render_csv(cls, data):
+        """Return a zip archive with a CSV file for each section
+
+        The sections are the ones of the report, the detail records are
+        written as they are fetched."""
+        columns = cls._get_date_columns(data['from_date'], data['to_date'],
+            data.get('granularity', 'month'))
+        labels = [x['lbl'] for x in columns.values()] + ['Total']
+        sections = cls._get_cached_sections(data, columns)
+        sections.update(cls._get_detail_sections(data))
+        size = config.getint('cashflow', 'spool_size', default=2 ** 20)
+
+        with tempfile.SpooledTemporaryFile(max_size=size) as content:
+            with zipfile.ZipFile(content, 'w', zipfile.ZIP_DEFLATED) as zip_:
+                for source in cls._get_sources():
+                    writer, file_ = cls._open_csv(
+                        zip_, '%s_summary.csv' % source.section)
+                    with file_:
+                        writer.writerow([source.row] + labels)
+                        for record in sections[
+                                '%s_summary' % source.section]:
+                            writer.writerow(
+                                [record[source.row]] + record['columns'])
+
+                writer, file_ = cls._open_csv(zip_, 'synthesis.csv')
+                with file_:
+                    writer.writerow([''] + labels)
+                    for record in sections['synthesis']:
+                        writer.writerow([record['name']] + record['columns'])
+
+                if data.get('details', True):
+                    for source in cls._get_sources():
+                        writer, file_ = cls._open_csv(
+                            zip_, '%s_detail.csv' % source.section)
+                        with file_, phase('details.%s' % source.name):
+                            writer.writerow(['column', 'company', 'date',
+                                    'partner', 'category', 'amount'])
+                            for record in sections[
+                                    '%s_raw' % source.section]:
+                                writer.writerow([record['column'],
+                                        record['company'], record['date'],
+                                        record['partner'], record['category'],
+                                        record['amount']])
+
+                profiler = current_profiler()
+                if profiler and data.get('profile'):
+                    writer, file_ = cls._open_csv(zip_, 'profile.csv')
+                    with file_:
+                        writer.writerow(
+                            ['phase', 'seconds', 'queries', 'rows'])
+                        for measure in profiler.phases:
+                            writer.writerow([measure['name'],
+                                    measure['seconds'], measure['queries'],
+                                    measure['rows']])
+            content.seek(0)
+            return content.read()
+
+    @staticmethod
+    def _open_csv(zip_, name):
+        file_ = io.TextIOWrapper(zip_.open(name, 'w'), encoding='utf-8',
+            newline='')
+        return csv.writer(file_), file_
+
+    @classmethod
+    def _get_rows(cls, data, source, rates, categories):
+        """Yield the fetched rows of the source with the names of party,
+        category and currency
+
+        The party names are read by batch of rows."""
+        pool = Pool()
+        Company = pool.get('company.company')
+        Party = pool.get('party.party')
+        companies = dict((c.id, c.rec_name)
+            for c in Company.browse(cls._get_companies(data)))
+        rows = cls._fetch(data, source, rates)
+        size = config.getint('cashflow', 'chunk', default=1000)
+        while True:
+            batch = list(islice(rows, size))
+            if not batch:
+                break
+            names = dict((p.id, p.rec_name) for p in Party.browse(
+                    list(set(r[3] for r in batch if r[3]))))
+            for (company_id, date, category_id, party_id,
+                    currency_id, amount, report_amount) in batch:
+                yield {
+                    'company_id': company_id,
+                    'company': companies.get(company_id, ''),
+                    'date': date,
+                    'partner_id': party_id,
+                    'partner': names.get(party_id, ''),
+                    'category_id': category_id,
+                    'category': categories.get(category_id, ''),
+                    'currency': rates.currency(currency_id).code,
+                    'amount': amount,
+                    'report_amount': report_amount,
+                    }
+
+    @classmethod
+    def _get_cache_key(cls, data):
+        return (data['company'], tuple(data.get('scenarios') or []),
+            tuple(cls._get_companies(data)),
+            tuple(cls._get_roots(data)), cls._get_currency(data).id,
+            data['from_date'], data['to_date'],
+            data.get('granularity', 'month'), data.get('use_summary'))
+
+    @staticmethod
+    def _get_companies(data):
+        "Return the ids of the companies of the report"
+        return data.get('companies') or [data['company']]
 
-        report_context['company'] = Company(data['company'])
-        report_context['from_date'] = data['from_date']
-        report_context['to_date'] = data['to_date']
+    @staticmethod
+    def _get_roots(data):
+        "Return the ids of the analytic roots of the categories"
+        return data.get('analytic_accounts') or [data['analytic_account']]
 
-        columns = cls._get_date_columns(data['from_date'], data['to_date'])
-        report_context['columns'] = [x['lbl']
-            for x in columns.values()] + ['Total']
-        if len(report_context['columns']) < MAX_COLS:
-            for idx in range(MAX_COLS - len(report_context['columns'])):
-                report_context['columns'].append('')
+    @classmethod
+    def _get_currency(cls, data):
+        "Return the currency in which the amounts are reported"
+        pool = Pool()
+        Company = pool.get('company.company')
+        Currency = pool.get('currency.currency')
+        if data.get('currency'):
+            return Currency(data['currency'])
+        return Company(data['company']).currency
 
-        # Sales
-        sales_raw = cls._get_sale_records(data)
-        report_context['sales_raw'] = sales_raw.values()
+    @classmethod
+    def _get_pivot(cls, data, columns):
+        """Return the pivot of the report
 
-        sales_summary = cls._get_sale_summary(columns, sales_raw)
-        report_context['sales_summary'] = sales_summary.values()
+        When the report has many companies, the pivot has a result row for
+        each company and the rows of the summaries are grouped by name."""
+        pool = Pool()
+        Company = pool.get('company.company')
+        pivot = Pivot(columns, cls._get_currency(data).digits)
+        companies = cls._get_companies(data)
+        if len(companies) > 1:
+            for company in Company.browse(companies):
+                pivot.add_group(company.id, 'Resultado %s' % company.rec_name)
+        return pivot
 
-        # Expenses
-        expenses_raw = cls._get_expense_records(data)
-        report_context['expenses_raw'] = expenses_raw.values()
+    @classmethod
+    def _get_cached_sections(cls, data, columns):
+        "Return a copy of the summary and synthesis sections from the cache"
+        key = cls._get_cache_key(data)
+        sections = cls._cache.get(key)
+        if sections is None:
+            sections = cls._get_sections(data, columns)
+            cls._cache.set(key, sections)
+        return dict(sections)
 
-        expenses_summary = cls._get_expense_summary(columns, expenses_raw)
-        report_context['expenses_summary'] = expenses_summary.values()
+    @classmethod
+    def _get_sections(cls, data, columns):
+        "Return the computed summary and synthesis sections"
+        sections = {}
+        with phase('rates'):
+            rates = RateTable(data['from_date'], data['to_date'])
+        with phase('categories'):
+            categories = cls._get_categories(data)
+        pivot = cls._get_pivot(data, columns)
 
-        # Cooperative Receipts
-        receipts_raw = cls._get_receipt_records(data)
-        report_context['receipts_raw'] = receipts_raw.values()
+        sources = cls._get_sources()
+        cls._add_sources(data, pivot, sources, rates, categories)
+        for source in sources:
+            sections['%s_summary' % source.section] = pivot.summary(
+                source.name, source.row)
 
-        receipts_summary = cls._get_receipt_summary(columns, receipts_raw)
-        report_context['receipts_summary'] = receipts_summary.values()
+        cls._add_scenarios(data, pivot, rates)
+        cls._add_balance(data, pivot, rates)
 
         # Synthesis
-        synthesis = cls._get_synthesis(columns,
-            sales_summary, expenses_summary, receipts_summary)
-        report_context['synthesis'] = synthesis.values()
+        with phase('synthesis'):
+            sections['synthesis'] = pivot.synthesis('Resultado')
 
-        return report_context
+        return sections
+
+    @classmethod
+    def _add_scenarios(cls, data, pivot, rates):
+        """Add to the pivot the result of the scenarios
+
+        The formulas of each scenario are applied to the projected amount
+        of each source and column and only the differences are added to the
+        result."""
+        pool = Pool()
+        Scenario = pool.get('cooperative_ar.cashflow.scenario')
+
+        scenarios = Scenario.browse(data.get('scenarios') or [])
+        with phase('scenarios'):
+            formulas = dict(((scenario.id, source.name),
+                        scenario.get_formula(source.name))
+                for scenario in scenarios for source in cls._get_sources())
+            projected = {}
+            for source in cls._get_sources():
+                if not any(formulas[s.id, source.name] for s in scenarios):
+                    continue
+                # the formulas are applied to the amount of the column
+                totals = defaultdict(Decimal)
+                for _, date, _, _, _, _, amount in getattr(
+                        cls, '_fetch_%s' % source.name)(
+                        {**data, 'projected': True}, rates):
+                    totals[date] += amount
+                projected[source.name] = sorted(totals.items())
+
+            for scenario in scenarios:
+                pivot.add_scenario(scenario.id,
+                    'Resultado %s' % scenario.rec_name)
+                for source, totals in projected.items():
+                    formula = formulas[scenario.id, source]
+                    if not formula:
+                        continue
+                    amounts = formula.map(
+                        Scenario.get_formula_names(
+                            data['from_date'], date, total)
+                        for date, total in totals)
+                    for (date, total), amount in zip(totals, amounts):
+                        pivot.adjust(scenario.id, source, date,
+                            amount - total)
+
+    @classmethod
+    def _add_balance(cls, data, pivot, rates):
+        """Add to the pivot the cash position from the balance at the from
+        date of the cash accounts of the companies"""
+        pool = Pool()
+        Account = pool.get('account.account')
+
+        with phase('balance'):
+            if not Account.search([
+                        ('company', 'in', cls._get_companies(data)),
+                        ('cashflow_balance', '=', True),
+                        ], limit=1):
+                return
+            currency = cls._get_currency(data)
+            cursor = Transaction().connection.cursor()
+            cursor.execute(*cls._get_balance_query(data))
+            opening = Decimal(0)
+            for currency_id, amount in cursor:
+                opening += rates.compute(currency_id, Decimal(str(amount)),
+                    currency, data['from_date'])
+            pivot.set_opening(opening, 'Saldo inicial', 'Saldo acumulado',
+                'Saldo mínimo')
+
+    @classmethod
+    def _get_balance_query(cls, data):
+        pool = Pool()
+        Company = pool.get('company.company')
+        Move = pool.get('account.move')
+        MoveLine = pool.get('account.move.line')
+        Account = pool.get('account.account')
+        company = Company.__table__()
+        move = Move.__table__()
+        line = MoveLine.__table__()
+        account = Account.__table__()
+
+        # the amounts of the lines are in the currency of the company
+        return line.join(move, condition=line.move == move.id
+            ).join(company, condition=move.company == company.id
+            ).join(account, condition=line.account == account.id
+            ).select(
+                company.currency, Sum(line.debit - line.credit),
+                where=(move.company.in_(cls._get_companies(data))
+                    & (account.cashflow_balance == Literal(True))
+                    & (move.state == 'posted')
+                    & (move.date < data['from_date'])),
+                group_by=[company.currency])
 
     @classmethod
-    def _get_date_columns(cls, from_date, to_date):
+    def _get_date_columns(cls, from_date, to_date, granularity='month'):
+        "Return the columns keyed by their first day"
         res = {}
-        date = from_date
+        date = cls._get_bucket(from_date, granularity)
+        delta = {
+            'day': relativedelta(days=1),
+            'week': relativedelta(weeks=1),
+            'month': relativedelta(months=1),
+            'quarter': relativedelta(months=3),
+            }[granularity]
         idx = 0
-        while date < to_date and idx < MAX_COLS:
-            year, month = date.year, date.month
-            res[(year, month)] = {'idx': idx, 'lbl': '%s/%s' % (month, year)}
-            date = date + relativedelta(months=1)
+        while date <= to_date:
+            res[date] = {
+                'idx': idx,
+                'lbl': cls._get_column_label(date, granularity),
+                }
+            date = date + delta
             idx += 1
         return res
 
+    @staticmethod
+    def _get_column_label(date, granularity):
+        if granularity in {'day', 'week'}:
+            return date.strftime('%d/%m/%Y')
+        elif granularity == 'quarter':
+            return 'T%s/%s' % ((date.month - 1) // 3 + 1, date.year)
+        return '%s/%s' % (date.month, date.year)
+
     @classmethod
-    def _get_sale_records(cls, data):
+    def _get_categories(cls, data):
+        "Return the names of the analytic accounts under the selected roots"
         pool = Pool()
-        Company = pool.get('company.company')
-        Currency = pool.get('currency.currency')
-        SaleLine = pool.get('sale.line')
         AnalyticAccount = pool.get('analytic_account.account')
+        accounts = AnalyticAccount.search_read([
+                ('root', 'in', cls._get_roots(data)),
+                ], fields_names=['name'])
+        return dict((a['id'], a['name']) for a in accounts)
 
-        records = {}
-        company = Company(data['company'])
-
-        clause = [
-            ('sale.company', '=', data['company']),
-            ('sale.state', 'in',
-                ['projected', 'confirmed', 'processing', 'done']),
-            ('type', '=', 'line'),
-            ('manual_delivery_date', '>=', data['from_date']),
-            ('manual_delivery_date', '<=', data['to_date']),
+    @classmethod
+    def _get_sources(cls):
+        """Return the cash-flow sources in the order of the synthesis
+
+        The amounts of each source are fetched by _fetch_<name>."""
+        return [
+            CashFlowSource('sale', 'Ventas', 1, 'category', 'sales'),
+            CashFlowSource('purchase', 'Compras', -1, 'category',
+                'purchases'),
+            CashFlowSource('expense', 'Gastos', -1, 'category', 'expenses'),
+            CashFlowSource('receipt', 'Retiros', -1, 'partner', 'receipts'),
             ]
-        sale_lines = SaleLine.search(clause,
-            order=[('manual_delivery_date', 'ASC')])
-        if not sale_lines:
-            return records
-
-        for line in sale_lines:
-            year = line.manual_delivery_date.year
-            month = line.manual_delivery_date.month
-            category_id = None
-            for analytic_line in line.analytic_accounts:
-                if (analytic_line.root.id == data['analytic_account'] and
-                        analytic_line.account):
-                    category_id = analytic_line.account.id
-            key = (year, month, category_id)
+
+    @classmethod
+    def _get_detail_sections(cls, data):
+        """Return the detail sections of the sources, empty without details
+
+        The records are fetched while the template iterates over them so they
+        are not kept in memory."""
+        sources = cls._get_sources()
+        if not data.get('details', True):
+            return dict(('%s_raw' % s.section, []) for s in sources)
+        rates = RateTable(data['from_date'], data['to_date'])
+        categories = cls._get_categories(data)
+        return dict(('%s_raw' % s.section,
+                cls._iter_details(data, s, rates, categories))
+            for s in sources)
+
+    @classmethod
+    def _iter_details(cls, data, source, rates, categories):
+        "Yield the detail records of the source up to the limit"
+        details = cls._get_details(
+            cls._get_rows(data, source.name, rates, categories),
+            data.get('granularity', 'month'))
+        try:
+            yield from islice(details, data.get('details_limit'))
+        finally:
+            # release the cursor when the limit is reached
+            details.close()
+
+    @classmethod
+    def _add_sources(cls, data, pivot, sources, rates, categories):
+        """Add the rows of the sources to the pivot
+
+        When the cashflow workers option of the configuration is greater
+        than 1, the sources are pivoted concurrently by threads, each one
+        with its own read-only transaction, and merged."""
+        for source in sources:
+            pivot.add_source(source.name, source.label, source.sign)
+        workers = config.getint('cashflow', 'workers', default=1)
+        if workers <= 1 or len(sources) <= 1 or backend.name == 'sqlite':
+            for source in sources:
+                cls._add_source(data, pivot, source, rates, categories)
+            return
+
+        transaction = Transaction()
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            futures = [executor.submit(cls._get_source_pivot_in_transaction,
+                    transaction.database.name, transaction.user,
+                    transaction.context, data, pivot.columns, s, categories,
+                    current_profiler())
+                for s in sources]
+            for future in futures:
+                pivot.merge(future.result())
+
+    @classmethod
+    def _get_source_pivot_in_transaction(cls, database_name, user, context,
+            data, columns, source, categories, profiler=None):
+        with Transaction().start(database_name, user, readonly=True,
+                context=context), activate(profiler):
+            rates = RateTable(data['from_date'], data['to_date'])
+            pivot = cls._get_pivot(data, columns)
+            pivot.add_source(source.name, source.label, source.sign)
+            cls._add_source(data, pivot, source, rates, categories)
+            return pivot
+
+    @classmethod
+    def _add_source(cls, data, pivot, source, rates, categories):
+        "Add the rows of the source to the pivot"
+        with phase('records.%s' % source.name):
+            for row in cls._get_rows(data, source.name, rates, categories):
+                cls._add_row(pivot, source, row)
+
+    @staticmethod
+    def _add_row(pivot, source, row):
+        # the same names of the companies are summed
+        key = (row[source.row] if pivot.groups
+            else row['%s_id' % source.row])
+        pivot.add(source.name, key, row[source.row], row['date'],
+            row['report_amount'], group=row['company_id'])
+
+    @classmethod
+    def _get_details(cls, rows, granularity='month'):
+        """Yield the detail records of the rows summed by company, date,
+        party and category
+
+        The rows are in the order of the columns so only the records of one
+        column are summed at a time. The column is labeled like in the
+        synthesis."""
+        records = {}
+        date = None
+        for row in rows:
+            if row['date'] != date:
+                yield from records.values()
+                records = {}
+                date = row['date']
+            key = (row['company_id'], row['partner_id'], row['category_id'])
             if key not in records:
                 records[key] = {
-                    'year': year,
-                    'month': month,
-                    'category': (category_id and
-                        AnalyticAccount(category_id).name or ''),
+                    'company': row['company'],
+                    'date': date,
+                    'column': cls._get_column_label(date, granularity),
+                    'year': date.year,
+                    'month': date.month,
+                    'partner': row['partner'],
+                    'category': row['category'],
                     'amount': Decimal(0),
                     }
-            with Transaction().set_context(date=line.manual_delivery_date):
-                records[key]['amount'] += Currency.compute(
-                    company.currency, line.amount, line.currency)
-        return records
+            records[key]['amount'] += row['report_amount']
+        yield from records.values()
 
     @classmethod
-    def _get_sale_summary(cls, columns, sales_raw):
-        records = {}
-        for key, line in sales_raw.items():
-            category_id = key[2]
-            if category_id not in records:
-                records[category_id] = {
-                    'category': line['category'],
-                    'columns': dict((idx, None) for idx in range(MAX_COLS)),
-                    'total': Decimal(0),
-                    }
-            date = key[:2]
-            if date not in columns:
-                continue
-            records[category_id]['columns'][columns[date]['idx']] = line[
-                'amount']
-            records[category_id]['total'] += line['amount']
+    def _fetch(cls, data, source, rates):
+        """Yield the amounts of the source grouped as
+        (company, date, category, party, currency, amount,
+        amount in the report currency)
 
-        total_idx = len(columns)
-        for k, v in records.items():
-            v['columns'][total_idx] = v['total']
-        return records
+        The date is the first day of the column of the amount."""
+        pool = Pool()
+        Summary = pool.get('cooperative_ar.cashflow.summary')
+        if data.get('use_summary') and Summary.can_fetch(data, source):
+            return Summary.fetch(data, source, rates)
+        return getattr(cls, '_fetch_%s' % source)(data, rates)
 
     @classmethod
-    def _get_purchase_records(cls):
-        return []
+    def _fetch_query(cls, data, rates, query):
+        currency = cls._get_currency(data)
+        granularity = data.get('granularity', 'month')
+        for (company_id, bucket, date, category_id, party_id,
+                currency_id, amount) in fetch_chunks(query):
+            amount = Decimal(str(amount))
+            # the rate date has no SQL type so sqlite returns a string
+            date = cls._get_date(date)
+            # amounts in the report currency are grouped by column,
+            # the others keep their date to be converted with its rate
+            yield (company_id, cls._get_bucket(bucket, granularity),
+                category_id, party_id, currency_id, amount, rates.compute(
+                    currency_id, amount, currency, date))
 
     @classmethod
-    def _get_expense_records(cls, data):
+    def _get_bucket_column(cls, data, date):
+        "Return the SQL expression of the first day of the column of date"
+        granularity = data.get('granularity', 'month')
+        # sqlite date_trunc does not support week and quarter so the
+        # amounts are grouped by day and their bucket computed by Python
+        if (backend.name == 'sqlite'
+                and granularity not in {'day', 'month'}):
+            return date
+        return DateTrunc(granularity, date)
+
+    @staticmethod
+    def _get_date(value):
+        "Return the date of the value returned by the database or None"
+        if isinstance(value, str):
+            return datetime.date.fromisoformat(value[:10])
+        elif isinstance(value, datetime.datetime):
+            return value.date()
+        return value
+
+    @classmethod
+    def _get_bucket(cls, date, granularity):
+        "Return the first day of the column of date"
+        date = cls._get_date(date)
+        if granularity == 'week':
+            return date - datetime.timedelta(days=date.weekday())
+        elif granularity == 'month':
+            return date.replace(day=1)
+        elif granularity == 'quarter':
+            return date.replace(month=(date.month - 1) // 3 * 3 + 1, day=1)
+        return date
+
+    @classmethod
+    def _fetch_sale(cls, data, rates):
+        return cls._fetch_query(data, rates, cls._get_sale_query(data))
+
+    @classmethod
+    def _get_sale_query(cls, data):
         pool = Pool()
+        Sale = pool.get('sale.sale')
+        SaleLine = pool.get('sale.line')
+        Currency = pool.get('currency.currency')
+        sale = Sale.__table__()
+        line = SaleLine.__table__()
+        currency = Currency.__table__()
+
+        date = line.manual_delivery_date
+        bucket = cls._get_bucket_column(data, date)
+        rate_date = Case(
+            (sale.currency == cls._get_currency(data).id, Null),
+            else_=date)
+        amount = Sum(Round(
+                SaleLine.unit_price.sql_cast(line.quantity) * line.unit_price,
+                currency.digits))
+        category = cls._get_entry_category(data, 'sale.line')
+
+        return line.join(sale, condition=line.sale == sale.id
+            ).join(currency, condition=sale.currency == currency.id
+            ).join(category, 'LEFT',
+                condition=category.origin == Concat('sale.line,', line.id)
+            ).select(
+                sale.company, bucket, rate_date, category.account,
+                Literal(None), sale.currency, amount,
+                where=(sale.company.in_(cls._get_companies(data))
+                    & sale.state.in_(cls._get_states(data,
+                            ['projected', 'confirmed', 'processing', 'done']))
+                    & (line.type == 'line')
+                    & (date >= data['from_date'])
+                    & (date <= data['to_date'])),
+                group_by=[sale.company, bucket, rate_date,
+                    category.account, sale.currency],
+                order_by=[bucket.asc])
+
+    @classmethod
+    def _fetch_purchase(cls, data, rates):
+        return cls._fetch_query(data, rates, cls._get_purchase_query(data))
+
+    @classmethod
+    def _get_purchase_query(cls, data):
+        pool = Pool()
+        Purchase = pool.get('purchase.purchase')
+        PurchaseLine = pool.get('purchase.line')
+        Currency = pool.get('currency.currency')
+        purchase = Purchase.__table__()
+        line = PurchaseLine.__table__()
+        undated_purchase = Purchase.__table__()
+        undated_line = PurchaseLine.__table__()
+        currency = Currency.__table__()
+
+        # The lines without delivery date are dated by their purchase in a
+        # separate branch so the index on the delivery date can be used
+        dated = line.select(
+            line.id, line.purchase, line.quantity, line.unit_price,
+            line.delivery_date_store.as_('date'),
+            where=((line.type == 'line')
+                & (line.delivery_date_store >= data['from_date'])
+                & (line.delivery_date_store <= data['to_date'])))
+        undated = undated_line.join(undated_purchase,
+            condition=undated_line.purchase == undated_purchase.id
+            ).select(
+                undated_line.id, undated_line.purchase,
+                undated_line.quantity, undated_line.unit_price,
+                undated_purchase.purchase_date.as_('date'),
+                where=((undated_line.type == 'line')
+                    & (undated_line.delivery_date_store == Null)
+                    & (undated_purchase.purchase_date >= data['from_date'])
+                    & (undated_purchase.purchase_date <= data['to_date'])))
+        lines = Union(dated, undated, all_=True)
+
+        date = lines.date
+        bucket = cls._get_bucket_column(data, date)
+        rate_date = Case(
+            (purchase.currency == cls._get_currency(data).id, Null),
+            else_=date)
+        amount = Sum(Round(
+                PurchaseLine.unit_price.sql_cast(lines.quantity)
+                * lines.unit_price,
+                currency.digits))
+
+        # Analytic entries only exist when analytic_purchase is activated
+        category = cls._get_entry_category(data, 'purchase.line')
+        return lines.join(purchase, condition=lines.purchase == purchase.id
+            ).join(currency, condition=purchase.currency == currency.id
+            ).join(category, 'LEFT',
+                condition=category.origin == Concat(
+                    'purchase.line,', lines.id)
+            ).select(
+                purchase.company, bucket, rate_date, category.account,
+                Literal(None), purchase.currency, amount,
+                where=(purchase.company.in_(cls._get_companies(data))
+                    & purchase.state.in_(cls._get_states(data,
+                            ['projected', 'confirmed', 'processing']))),
+                group_by=[purchase.company, bucket, rate_date,
+                    category.account, purchase.currency],
+                order_by=[bucket.asc])
+
+    @classmethod
+    def _get_entry_category(cls, data, model):
+        """Return the query of the category of the analytic entries of the
+        model lines
+
+        One category per line even if the entries of many selected roots
+        are on the line."""
+        pool = Pool()
+        AnalyticEntry = pool.get('analytic.account.entry')
+        entry = AnalyticEntry.__table__()
+        return entry.select(
+            entry.origin, Max(entry.account).as_('account'),
+            where=(entry.root.in_(cls._get_roots(data))
+                & entry.origin.like(model + ',%')),
+            group_by=[entry.origin])
+
+    @classmethod
+    def _get_states(cls, data, states):
+        "Return the states of the documents or only projected"
+        if data.get('projected'):
+            return ['projected']
+        return states
+
+    @classmethod
+    def _fetch_expense(cls, data, rates):
+        # the moves are never projected
+        if data.get('projected'):
+            return iter([])
+        return cls._fetch_query(data, rates, cls._get_expense_query(data))
+
+    @classmethod
+    def _get_expense_query(cls, data):
+        pool = Pool()
+        Company = pool.get('company.company')
+        Move = pool.get('account.move')
         MoveLine = pool.get('account.move.line')
+        Account = pool.get('account.account')
         AnalyticAccount = pool.get('analytic_account.account')
+        AnalyticLine = pool.get('analytic_account.line')
+        company = Company.__table__()
+        move = Move.__table__()
+        line = MoveLine.__table__()
+        account = Account.__table__()
+        analytic_account = AnalyticAccount.__table__()
+        analytic_line = AnalyticLine.__table__()
 
-        records = {}
+        # One category per move line even if it has many analytic lines
+        # under the selected roots
+        category = analytic_line.join(analytic_account,
+            condition=analytic_line.account == analytic_account.id
+            ).select(
+                analytic_line.move_line,
+                Max(analytic_line.account).as_('account'),
+                where=analytic_account.root.in_(cls._get_roots(data)),
+                group_by=[analytic_line.move_line])
 
-        clause = [
-            ('move.company', '=', data['company']),
-            ('account.cashflow_report', '=', True),
-            ('move.state', '=', 'posted'),
-            ('move.date', '>=', data['from_date']),
-            ('move.date', '<=', data['to_date']),
-            ]
-        move_lines = MoveLine.search(clause,
-            order=[('move.date', 'ASC')])
-        if not move_lines:
-            return records
-
-        for line in move_lines:
-            year = line.move.date.year
-            month = line.move.date.month
-            category_id = None
-            for analytic_line in line.analytic_lines:
-                if (analytic_line.account.root.id ==
-                        data['analytic_account'] and
-                        analytic_line.account):
-                    category_id = analytic_line.account.id
-            key = (year, month, category_id)
-            if key not in records:
-                records[key] = {
-                    'year': year,
-                    'month': month,
-                    'category': (category_id and
-                        AnalyticAccount(category_id).name or ''),
-                    'amount': Decimal(0),
-                    }
-            with Transaction().set_context(date=line.move.date):
-                records[key]['amount'] += abs(line.debit - line.credit)
-        return records
+        bucket = cls._get_bucket_column(data, move.date)
+        rate_date = Case(
+            (company.currency == cls._get_currency(data).id, Null),
+            else_=move.date)
+        return line.join(move, condition=line.move == move.id
+            ).join(company, condition=move.company == company.id
+            ).join(account, condition=line.account == account.id
+            ).join(category, 'LEFT',
+                condition=category.move_line == line.id
+            ).select(
+                move.company, bucket, rate_date, category.account,
+                Literal(None), company.currency,
+                Sum(Abs(line.debit - line.credit)),
+                where=(move.company.in_(cls._get_companies(data))
+                    & (account.cashflow_report == Literal(True))
+                    & (move.state == 'posted')
+                    & (move.date >= data['from_date'])
+                    & (move.date <= data['to_date'])),
+                group_by=[move.company, bucket, rate_date,
+                    category.account, company.currency],
+                order_by=[bucket.asc])
 
     @classmethod
-    def _get_expense_summary(cls, columns, expenses_raw):
-        records = {}
-        for key, line in expenses_raw.items():
-            category_id = key[2]
-            if category_id not in records:
-                records[category_id] = {
-                    'category': line['category'],
-                    'columns': dict((idx, None) for idx in range(MAX_COLS)),
-                    'total': Decimal(0),
-                    }
-            date = key[:2]
-            if date not in columns:
+    def _fetch_receipt(cls, data, rates):
+        return cls._fetch_query(data, rates, cls._get_receipt_query(data))
+
+    @classmethod
+    def _get_receipt_query(cls, data):
+        pool = Pool()
+        Recibo = pool.get('cooperative.partner.recibo')
+        recibo = Recibo.__table__()
+
+        bucket = cls._get_bucket_column(data, recibo.date)
+        rate_date = Case(
+            (recibo.currency == cls._get_currency(data).id, Null),
+            else_=recibo.date)
+
+        # receipts have no analytic accounts
+        return recibo.select(
+            recibo.company, bucket, rate_date, Literal(None),
+            recibo.partner, recibo.currency, Sum(recibo.amount),
+            where=(recibo.company.in_(cls._get_companies(data))
+                & recibo.state.in_(
+                    cls._get_states(data, ['projected', 'confirmed']))
+                & (recibo.date >= data['from_date'])
+                & (recibo.date <= data['to_date'])),
+            group_by=[recibo.company, bucket, rate_date,
+                recibo.partner, recibo.currency],
+            order_by=[bucket.asc])
+
+
+class CashFlowRequest(ModelSQL, ModelView):
+    'Cash-Flow Request'
+    __name__ = 'cooperative_ar.cashflow.request'
+
+    company = fields.Many2One('company.company', 'Company', required=True,
+        readonly=True)
+    analytic_account = fields.Many2One('analytic_account.account',
+        'Analytic Account', required=True, readonly=True)
+    from_date = fields.Date('From Date', required=True, readonly=True)
+    to_date = fields.Date('To Date', required=True, readonly=True)
+    currency = fields.Many2One('currency.currency', 'Currency',
+        required=True, readonly=True)
+    granularity = fields.Selection([
+            ('day', 'Day'),
+            ('week', 'Week'),
+            ('month', 'Month'),
+            ('quarter', 'Quarter'),
+            ], 'Granularity', required=True, readonly=True)
+    use_summary = fields.Boolean('Use Summary', readonly=True)
+    format = fields.Selection([
+            ('ods', 'ODS'),
+            ('csv', 'CSV'),
+            ], 'Format', required=True, readonly=True)
+    details = fields.Boolean('Details', readonly=True)
+    details_limit = fields.Integer('Details Limit', readonly=True)
+    state = fields.Selection([
+        ('pending', 'Pending'),
+        ('done', 'Done'),
+        ('failed', 'Failed'),
+        ], 'State', required=True, readonly=True, select=True)
+    report = fields.Binary('Report', filename='report_name', readonly=True)
+    report_name = fields.Char('Report Name', readonly=True)
+    error = fields.Text('Error', readonly=True,
+        states={
+            'invisible': Eval('state') != 'failed',
+            },
+        depends=['state'])
+    users = fields.Many2Many('cooperative_ar.cashflow.request-res.user',
+        'request', 'user', 'Users', readonly=True,
+        help='The users notified when the report is generated.')
+
+    @classmethod
+    def __setup__(cls):
+        super().__setup__()
+        cls._order.insert(0, ('create_date', 'DESC'))
+
+    @staticmethod
+    def default_state():
+        return 'pending'
+
+    @staticmethod
+    def default_granularity():
+        return 'month'
+
+    @staticmethod
+    def default_format():
+        return 'ods'
+
+    @staticmethod
+    def default_details():
+        return True
+
+    def get_rec_name(self, name):
+        return '%s %s - %s' % (self.analytic_account.rec_name,
+            self.from_date, self.to_date)
+
+    def get_data(self):
+        return {
+            'company': self.company.id,
+            'analytic_account': self.analytic_account.id,
+            'from_date': self.from_date,
+            'to_date': self.to_date,
+            'currency': self.currency.id,
+            'granularity': self.granularity,
+            'use_summary': self.use_summary,
+            'format': self.format,
+            'details': self.details,
+            'details_limit': self.details_limit,
+            }
+
+    @classmethod
+    def get_request(cls, data):
+        """Return the pending request for data or queue a new one
+
+        The user is notified when the request is processed."""
+        user = Transaction().user
+        requests = cls.search([
+                ('company', '=', data['company']),
+                ('analytic_account', '=', data['analytic_account']),
+                ('from_date', '=', data['from_date']),
+                ('to_date', '=', data['to_date']),
+                ('currency', '=', data['currency']),
+                ('granularity', '=', data.get('granularity', 'month')),
+                ('use_summary', '=', bool(data.get('use_summary'))),
+                ('format', '=', data.get('format', 'ods')),
+                ('details', '=', data.get('details', True)),
+                ('details_limit', '=', data.get('details_limit')),
+                ('state', '=', 'pending'),
+                ], limit=1)
+        if requests:
+            request, = requests
+            if user not in [u.id for u in request.users]:
+                cls.write([request], {
+                        'users': [('add', [user])],
+                        })
+        else:
+            request, = cls.create([{
+                        'company': data['company'],
+                        'analytic_account': data['analytic_account'],
+                        'from_date': data['from_date'],
+                        'to_date': data['to_date'],
+                        'currency': data['currency'],
+                        'granularity': data.get('granularity', 'month'),
+                        'use_summary': bool(data.get('use_summary')),
+                        'format': data.get('format', 'ods'),
+                        'details': data.get('details', True),
+                        'details_limit': data.get('details_limit'),
+                        'users': [('add', [user])],
+                        }])
+            cls.__queue__.process([request])
+        return request
+
+    @classmethod
+    def process(cls, requests):
+        """Generate the report of the pending requests
+
+        The report is generated in its own transaction so its failure
+        leaves the transaction of the request usable to store the error.
+        The operational errors are raised for the queue to retry."""
+        pool = Pool()
+        Report = pool.get('cooperative_ar.cashflow', type='report')
+        transaction = Transaction()
+        for request in requests:
+            if request.state != 'pending':
                 continue
-            records[category_id]['columns'][columns[date]['idx']] = line[
-                'amount']
-            records[category_id]['total'] += line['amount']
+            try:
+                with transaction.new_transaction(readonly=True):
+                    oext, content, _, name = Report.execute(
+                        [], request.get_data())
+            except backend.DatabaseOperationalError:
+                raise
+            except Exception as exception:
+                request.state = 'failed'
+                request.error = str(exception)
+                message = 'cooperative_cashflow_ar.msg_cashflow_request_failed'
+            else:
+                request.state = 'done'
+                request.report = content
+                request.report_name = '%s.%s' % (name, oext)
+                message = 'cooperative_cashflow_ar.msg_cashflow_request_done'
+            request.save()
+            for user in request.users or [request.create_uid]:
+                notify(gettext(message, request=request.rec_name),
+                    user=user.id)
 
-        total_idx = len(columns)
-        for k, v in records.items():
-            v['columns'][total_idx] = v['total']
-        return records
+
+class CashFlowRequestUser(ModelSQL):
+    'Cash-Flow Request - User'
+    __name__ = 'cooperative_ar.cashflow.request-res.user'
+
+    request = fields.Many2One('cooperative_ar.cashflow.request', 'Request',
+        ondelete='CASCADE', required=True, select=True)
+    user = fields.Many2One('res.user', 'User', ondelete='CASCADE',
+        required=True, select=True)
+
+
+class CashFlowScenario(ModelSQL, ModelView):
+    'Cash-Flow Scenario'
+    __name__ = 'cooperative_ar.cashflow.scenario'
+
+    name = fields.Char('Name', required=True, translate=True)
+    sale_formula = fields.Char('Sale Formula',
+        help=('Python expression that will be evaluated for the projected '
+            'sales with:\n'
+            '- amount: the amount of the month\n'
+            '- year, month: the month\n'
+            '- months: the months from the From Date of the report'))
+    purchase_formula = fields.Char('Purchase Formula',
+        help=('Python expression that will be evaluated for the projected '
+            'purchases with:\n'
+            '- amount: the amount of the month\n'
+            '- year, month: the month\n'
+            '- months: the months from the From Date of the report'))
+    receipt_formula = fields.Char('Receipt Formula',
+        help=('Python expression that will be evaluated for the projected '
+            'receipts with:\n'
+            '- amount: the amount of the month\n'
+            '- year, month: the month\n'
+            '- months: the months from the From Date of the report'))
+
+    @classmethod
+    def __setup__(cls):
+        super().__setup__()
+        cls._order.insert(0, ('name', 'ASC'))
 
     @classmethod
-    def _get_receipt_records(cls, data):
+    def validate(cls, scenarios):
+        super().validate(scenarios)
+        for scenario in scenarios:
+            scenario.check_formulas()
+
+    def check_formulas(self):
+        pool = Pool()
+        Date = pool.get('ir.date')
+        today = Date.today()
+        names = self.get_formula_names(today, today, Decimal(0))
+        for source in ['sale', 'purchase', 'receipt']:
+            try:
+                formula = self.get_formula(source)
+                if formula and not isinstance(formula(**names), Decimal):
+                    raise ValueError
+            except Exception as exception:
+                raise ValidationError(gettext(
+                        'cooperative_cashflow_ar.msg_invalid_formula',
+                        formula=getattr(self, '%s_formula' % source),
+                        exception=exception)) from exception
+
+    def get_formula(self, source):
+        "Return the parsed formula of the source or None"
+        expression = getattr(self, '%s_formula' % source, None)
+        if expression:
+            return Formula(expression,
+                ['amount', 'year', 'month', 'months'])
+
+    @staticmethod
+    def get_formula_names(from_date, date, amount):
+        "Return the names of the formula for the amount of the column"
+        return {
+            'amount': amount,
+            'year': date.year,
+            'month': date.month,
+            'months': months_between(from_date, date),
+            }
+
+    @classmethod
+    def write(cls, *args):
+        pool = Pool()
+        Report = pool.get('cooperative_ar.cashflow', type='report')
+        super().write(*args)
+        # The cached reports may use the scenarios
+        Report._cache.clear()
+
+
+class CashFlowSummary(ModelSQL, ModelView):
+    'Cash-Flow Summary'
+    __name__ = 'cooperative_ar.cashflow.summary'
+
+    company = fields.Many2One('company.company', 'Company', required=True,
+        readonly=True, select=True)
+    source = fields.Selection('get_sources', 'Source', required=True,
+        readonly=True, select=True)
+    root = fields.Many2One('analytic_account.account', 'Analytic Root',
+        readonly=True, select=True, ondelete='CASCADE',
+        help='Empty for the sources without analytic accounts.')
+    analytic_account = fields.Many2One('analytic_account.account',
+        'Analytic Account', readonly=True)
+    party = fields.Many2One('party.party', 'Party', readonly=True)
+    year = fields.Integer('Year', required=True, readonly=True)
+    month = fields.Integer('Month', required=True, readonly=True)
+    currency = fields.Many2One('currency.currency', 'Currency',
+        required=True, readonly=True)
+    amount = fields.Numeric('Amount', digits=(16, 2), readonly=True)
+    company_amount = fields.Numeric('Company Amount', digits=(16, 2),
+        readonly=True)
+
+    @classmethod
+    def __setup__(cls):
+        super().__setup__()
+        cls._order.insert(0, ('year', 'DESC'))
+        cls._order.insert(1, ('month', 'DESC'))
+
+    @classmethod
+    def __register__(cls, module_name):
+        super().__register__(module_name)
+        table = cls.__table_handler__(module_name)
+
+        # Migration from 6.1: the sources without analytic have no root
+        table.not_null_action('root', 'remove')
+
+        table.index_action(['company', 'source', 'root', 'year', 'month'],
+            'add')
+
+    @classmethod
+    def get_sources(cls):
+        pool = Pool()
+        Report = pool.get('cooperative_ar.cashflow', type='report')
+        return [(s.name, s.label) for s in Report._get_sources()]
+
+    @classmethod
+    def _get_root_sources(cls):
+        "Return the names of the sources summarized by analytic root"
+        pool = Pool()
+        Report = pool.get('cooperative_ar.cashflow', type='report')
+        return {s.name for s in Report._get_sources() if s.row == 'category'}
+
+    @classmethod
+    def can_fetch(cls, data, source):
+        """Return if the amounts of the source for data can be read from the
+        summary
+
+        The categories are summarized by root so the amounts of many roots of
+        the same company would be counted once for each root."""
+        pool = Pool()
+        AnalyticAccount = pool.get('analytic_account.account')
+        Report = pool.get('cooperative_ar.cashflow', type='report')
+        if source not in cls._get_root_sources():
+            return True
+        companies = [r.company.id
+            for r in AnalyticAccount.browse(Report._get_roots(data))]
+        return len(companies) == len(set(companies))
+
+    @staticmethod
+    def _period(date):
+        return date.year * 12 + date.month
+
+    @classmethod
+    def fetch(cls, data, source, rates):
+        """Yield the summarized amounts like the report sources
+
+        The amounts in another currency than the report and the company are
+        converted at the first day of the month."""
         pool = Pool()
         Company = pool.get('company.company')
-        Currency = pool.get('currency.currency')
-        Recibo = pool.get('cooperative.partner.recibo')
+        Report = pool.get('cooperative_ar.cashflow', type='report')
+        table = cls.__table__()
+        company = Company.__table__()
+
+        currency = Report._get_currency(data)
+        period = table.year * 12 + table.month
+        where = (table.company.in_(Report._get_companies(data))
+            & (table.source == source)
+            & (period >= cls._period(data['from_date']))
+            & (period <= cls._period(data['to_date'])))
+        if source in cls._get_root_sources():
+            where &= table.root.in_(Report._get_roots(data))
+        query = table.join(company,
+            condition=table.company == company.id
+            ).select(
+            table.company, table.year, table.month,
+            table.analytic_account, table.party, table.currency,
+            company.currency, Sum(table.amount),
+            Sum(table.company_amount),
+            where=where,
+            group_by=[table.company, table.year, table.month,
+                table.analytic_account, table.party, table.currency,
+                company.currency],
+            order_by=[table.year.asc, table.month.asc])
+        granularity = data.get('granularity', 'month')
+        for (company_id, year, month, category_id, party_id, currency_id,
+                company_currency_id, amount, company_amount
+                ) in fetch_chunks(query):
+            date = datetime.date(year, month, 1)
+            amount = Decimal(str(amount))
+            company_amount = Decimal(str(company_amount))
+            if currency_id == currency.id:
+                report_amount = amount
+            elif company_currency_id == currency.id:
+                report_amount = company_amount
+            else:
+                report_amount = rates.compute(company_currency_id,
+                    company_amount, currency, date)
+            yield (company_id, Report._get_bucket(date, granularity),
+                category_id, party_id, currency_id, amount, report_amount)
+
+    @staticmethod
+    def _period_date(period):
+        "Return the first day of the period"
+        year, month = divmod(period - 1, 12)
+        return datetime.date(year, month + 1, 1)
+
+    @staticmethod
+    def _merge_spans(spans):
+        "Return the (first, last) periods merged when they are consecutive"
+        merged = []
+        for first, last in sorted(spans):
+            if merged and merged[-1][1] >= first - 1:
+                merged[-1][1] = max(merged[-1][1], last)
+            else:
+                merged.append([first, last])
+        return merged
+
+    @classmethod
+    def update(cls, source, keys):
+        """Queue the refresh of the source on the months of the keys
+        starting with (company, date)
+
+        Only the months of the keys are refreshed, the consecutive ones
+        together."""
+        periods = defaultdict(set)
+        for company_id, date, *_ in keys:
+            if company_id and date:
+                periods[company_id].add(cls._period(date))
+        cls.invalidate([(source, company_id,
+                    cls._period_date(first), cls._period_date(last))
+                for company_id, company_periods in periods.items()
+                for first, last in cls._merge_spans(
+                    (p, p) for p in company_periods)])
+
+    @classmethod
+    def invalidate(cls, spans):
+        """Queue the refresh of the (source, company, from date, to date)
+
+        The summary is refreshed by the queue so the writes of the documents
+        do not update its rows which are shared by all of them."""
+        pool = Pool()
+        Pending = pool.get('cooperative_ar.cashflow.summary.pending')
+        spans = set(spans)
+        if spans:
+            pendings = Pending.create([{
+                        'source': source,
+                        'company': company_id,
+                        'from_date': from_date,
+                        'to_date': to_date,
+                        } for source, company_id, from_date, to_date
+                    in spans])
+            Pending.__queue__.process(pendings)
+
+    @classmethod
+    def refresh(cls, source, company_id, from_date, to_date):
+        """Recompute the source for the months between the dates
+
+        The table is locked so concurrent refreshes of the same months do not
+        insert their amounts twice."""
+        pool = Pool()
         AnalyticAccount = pool.get('analytic_account.account')
+        Report = pool.get('cooperative_ar.cashflow', type='report')
+        table = cls.__table__()
+        transaction = Transaction()
+        transaction.database.lock(transaction.connection, cls._table)
+        cursor = transaction.connection.cursor()
 
-        records = {}
-        company = Company(data['company'])
+        from_date = from_date + relativedelta(day=1)
+        to_date = to_date + relativedelta(day=31)
+        period = table.year * 12 + table.month
+        cursor.execute(*table.delete(
+                where=((table.company == company_id)
+                    & (table.source == source)
+                    & (period >= cls._period(from_date))
+                    & (period <= cls._period(to_date)))))
 
-        clause = [
-            ('company', '=', data['company']),
-            ('state', 'in', ['projected', 'confirmed']),
-            ('date', '>=', data['from_date']),
-            ('date', '<=', data['to_date']),
-            ]
-        receipts = Recibo.search(clause,
-            order=[('date', 'ASC')])
-        if not receipts:
-            return records
-
-        for line in receipts:
-            year = line.date.year
-            month = line.date.month
-            category_id = None
-            #for analytic_line in line.analytic_accounts:
-                #if (analytic_line.root.id == data['analytic_account'] and
-                        #analytic_line.account):
-                    #category_id = analytic_line.account.id
-            key = (year, month, line.partner.id, category_id)
-            if key not in records:
-                records[key] = {
-                    'year': year,
-                    'month': month,
-                    'partner': line.partner.rec_name,
-                    'category': (category_id and
-                        AnalyticAccount(category_id).name or ''),
-                    'amount': Decimal(0),
-                    }
-            with Transaction().set_context(date=line.date):
-                records[key]['amount'] += Currency.compute(
-                    company.currency, line.amount, line.currency)
-        return records
+        rates = RateTable(from_date, to_date)
+        amounts = defaultdict(lambda: [Decimal(0), Decimal(0)])
+        if source in cls._get_root_sources():
+            roots = [r.id for r in AnalyticAccount.search([
+                        ('company', '=', company_id),
+                        ('type', '=', 'root'),
+                        ])]
+        else:
+            # the amounts are the same for all the roots
+            roots = [None]
+        for root_id in roots:
+            data = {
+                'company': company_id,
+                'analytic_account': root_id,
+                'from_date': from_date,
+                'to_date': to_date,
+                }
+            for (_, date, category_id, party_id, currency_id,
+                    amount, company_amount) in Report._fetch(
+                        data, source, rates):
+                key = (root_id, category_id, party_id, date.year,
+                    date.month, currency_id)
+                amounts[key][0] += amount
+                amounts[key][1] += company_amount
+
+        columns = [table.create_uid, table.create_date, table.company,
+            table.source, table.root, table.analytic_account, table.party,
+            table.year, table.month, table.currency, table.amount,
+            table.company_amount]
+        values = [[transaction.user, CurrentTimestamp(), company_id, source]
+            + list(k) + v for k, v in amounts.items()]
+        count = transaction.database.IN_MAX // len(columns)
+        for sub_values in grouped_slice(values, count=count):
+            cursor.execute(*table.insert(columns, values=list(sub_values)))
+
+        # The documents of the source have changed
+        Report._cache.clear()
 
     @classmethod
-    def _get_receipt_summary(cls, columns, receipts_raw):
-        records = {}
-        for key, line in receipts_raw.items():
-            partner_id = key[2]
-            if partner_id not in records:
-                records[partner_id] = {
-                    'partner': line['partner'],
-                    'columns': dict((idx, None) for idx in range(MAX_COLS)),
-                    'total': Decimal(0),
-                    }
-            date = key[:2]
-            if date not in columns:
-                continue
-            records[partner_id]['columns'][columns[date]['idx']] = line[
-                'amount']
-            records[partner_id]['total'] += line['amount']
+    def rebuild(cls, company_ids):
+        "Recompute all the summaries of the companies from the documents"
+        for company_id in company_ids:
+            for source, _ in cls.get_sources():
+                cls.refresh(source, company_id,
+                    datetime.date.min, datetime.date.max)
 
-        total_idx = len(columns)
-        for k, v in records.items():
-            v['columns'][total_idx] = v['total']
-        return records
+
+class CashFlowSummaryPending(ModelSQL):
+    'Cash-Flow Summary Pending'
+    __name__ = 'cooperative_ar.cashflow.summary.pending'
+
+    company = fields.Many2One('company.company', 'Company', required=True,
+        ondelete='CASCADE', select=True)
+    source = fields.Selection('get_sources', 'Source', required=True)
+    from_date = fields.Date('From Date', required=True)
+    to_date = fields.Date('To Date', required=True)
 
     @classmethod
-    def _get_synthesis(cls, columns,
-            sales_summary, expenses_summary, receipts_summary):
-        records = {}
-        result_columns = dict((idx, None) for idx in range(MAX_COLS))
+    def get_sources(cls):
+        pool = Pool()
+        Summary = pool.get('cooperative_ar.cashflow.summary')
+        return Summary.get_sources()
 
-        # Sales
-        records[1] = {
-            'name': 'Ventas',
-            'columns': dict((idx, None) for idx in range(MAX_COLS)),
-            }
-        for record in sales_summary.values():
-            for idx, value in record['columns'].items():
-                if value is None:
-                    continue
-                if records[1]['columns'][idx] is None:
-                    records[1]['columns'][idx] = Decimal(0)
-                records[1]['columns'][idx] += value
-                if result_columns[idx] is None:
-                    result_columns[idx] = Decimal(0)
-                result_columns[idx] += value
-
-        # Expenses
-        records[2] = {
-            'name': 'Gastos',
-            'columns': dict((idx, None) for idx in range(MAX_COLS)),
-            }
-        for record in expenses_summary.values():
-            for idx, value in record['columns'].items():
-                if value is None:
-                    continue
-                if records[2]['columns'][idx] is None:
-                    records[2]['columns'][idx] = Decimal(0)
-                records[2]['columns'][idx] += value
-                if result_columns[idx] is None:
-                    result_columns[idx] = Decimal(0)
-                result_columns[idx] -= value
-
-        # Cooperative Receipts
-        records[3] = {
-            'name': 'Retiros',
-            'columns': dict((idx, None) for idx in range(MAX_COLS)),
-            }
-        for record in receipts_summary.values():
-            for idx, value in record['columns'].items():
-                if value is None:
-                    continue
-                if records[3]['columns'][idx] is None:
-                    records[3]['columns'][idx] = Decimal(0)
-                records[3]['columns'][idx] += value
-                if result_columns[idx] is None:
-                    result_columns[idx] = Decimal(0)
-                result_columns[idx] -= value
-
-        # Result
-        records[9] = {
-            'name': 'Resultado',
-            'columns': result_columns,
-            }
+    @classmethod
+    def process(cls, pendings):
+        """Refresh the summary on the months of the pendings
 
-        return records
+        All the pendings of the same company and source are processed
+        together so the months changed by many transactions are refreshed
+        once."""
+        pool = Pool()
+        Summary = pool.get('cooperative_ar.cashflow.summary')
+        keys = set((p.company.id, p.source) for p in pendings)
+        if not keys:
+            return
+        pendings = cls.search(['OR'] + [[
+                    ('company', '=', company_id),
+                    ('source', '=', source),
+                    ] for company_id, source in keys])
+        spans = defaultdict(list)
+        for pending in pendings:
+            spans[pending.company.id, pending.source].append(
+                (Summary._period(pending.from_date),
+                    Summary._period(pending.to_date)))
+        for (company_id, source), periods in spans.items():
+            for first, last in Summary._merge_spans(periods):
+                Summary.refresh(source, company_id,
+                    Summary._period_date(first), Summary._period_date(last))
+        cls.delete(pendings)
+
+
+class RebuildCashFlowSummaryStart(ModelView):
+    'Rebuild Cash-Flow Summary'
+    __name__ = 'cooperative_ar.cashflow.summary.rebuild.start'
+
+    company = fields.Many2One('company.company', 'Company', required=True)
+
+    @classmethod
+    def default_company(cls):
+        return Transaction().context.get('company')
+
+
+class RebuildCashFlowSummary(Wizard):
+    'Rebuild Cash-Flow Summary'
+    __name__ = 'cooperative_ar.cashflow.summary.rebuild'
+
+    start = StateView('cooperative_ar.cashflow.summary.rebuild.start',
+        'cooperative_cashflow_ar.cashflow_summary_rebuild_start_view', [
+            Button('Cancel', 'end', 'tryton-cancel'),
+            Button('Rebuild', 'rebuild', 'tryton-ok', True),
+            ])
+    rebuild = StateTransition()
+
+    def transition_rebuild(self):
+        pool = Pool()
+        Summary = pool.get('cooperative_ar.cashflow.summary')
+        Summary.rebuild([self.start.company.id])
+        return 'end'
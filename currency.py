@@ -0,0 +1,68 @@
+# This file is part of the cooperative_cashflow_ar module for Tryton.
+# The COPYRIGHT file at the top level of this repository contains
+# the full copyright notices and license terms.
+import datetime
+
+from trytond.pool import Pool, PoolMeta
+
+
+class Rate(metaclass=PoolMeta):
+    __name__ = 'currency.currency.rate'
+
+    @classmethod
+    def _get_cashflow_spans(cls, rates):
+        "Return the (from date, to date) during which the rates are used"
+        spans = set()
+        for rate in rates:
+            next_rates = cls.search([
+                    ('currency', '=', rate.currency.id),
+                    ('date', '>', rate.date),
+                    ], order=[('date', 'ASC')], limit=1)
+            if next_rates:
+                next_rate, = next_rates
+                to_date = next_rate.date - datetime.timedelta(days=1)
+            else:
+                to_date = datetime.date.max
+            spans.add((rate.date, to_date))
+        return spans
+
+    @classmethod
+    def _invalidate_cashflow(cls, spans):
+        """Queue the refresh of the summaries converted with the rates and
+        clear the cached reports"""
+        pool = Pool()
+        Company = pool.get('company.company')
+        Summary = pool.get('cooperative_ar.cashflow.summary')
+        Report = pool.get('cooperative_ar.cashflow', type='report')
+        companies = Company.search([])
+        Summary.invalidate([(source, company.id, from_date, to_date)
+                for from_date, to_date in spans
+                for company in companies
+                for source, _ in Summary.get_sources()])
+        # The cached reports are converted with the rates
+        Report._cache.clear()
+
+    @classmethod
+    def create(cls, vlist):
+        rates = super().create(vlist)
+        cls._invalidate_cashflow(cls._get_cashflow_spans(rates))
+        return rates
+
+    @classmethod
+    def write(cls, *args):
+        actions = iter(args)
+        rates = []
+        for sub_rates, values in zip(actions, actions):
+            if values.keys() & {'currency', 'date', 'rate'}:
+                rates.extend(sub_rates)
+        spans = cls._get_cashflow_spans(rates)
+        super().write(*args)
+        if rates:
+            spans |= cls._get_cashflow_spans(cls.browse(rates))
+            cls._invalidate_cashflow(spans)
+
+    @classmethod
+    def delete(cls, rates):
+        spans = cls._get_cashflow_spans(rates)
+        super().delete(rates)
+        cls._invalidate_cashflow(spans)
@@ -0,0 +1,43 @@
+# This file is part of the cooperative_cashflow_ar module for Tryton.
+# The COPYRIGHT file at the top level of this repository contains
+# the full copyright notices and license terms.
+import ast
+from decimal import Decimal
+from simpleeval import SimpleEval
+
+from trytond.tools import decistmt
+
+
+class Formula(object):
+    """Python expression parsed once and evaluated safely by simpleeval
+
+    The number literals are read as Decimal and only the given names and
+    the Decimal function can be used."""
+
+    def __init__(self, expression, names):
+        self.expression = expression
+        self.names = set(names)
+        self._evaluator = SimpleEval(functions={'Decimal': Decimal})
+        self._node = self._evaluator.parse(decistmt(expression))
+        for node in ast.walk(self._node):
+            if (isinstance(node, ast.Name)
+                    and node.id not in self.names
+                    and node.id not in self._evaluator.functions):
+                raise NameError("name '%s' is not defined" % node.id)
+
+    def __call__(self, **names):
+        self._evaluator.names = names
+        return self._evaluator.eval(
+            self.expression, previously_parsed=self._node)
+
+    def map(self, rows):
+        "Return the results of the evaluation for each dictionary of names"
+        return [self(**names) for names in rows]
+
+
+def months_between(from_date, to_date):
+    "Return the number of months from the month of from_date to to_date"
+    if not from_date or not to_date:
+        return 0
+    return ((to_date.year - from_date.year) * 12
+        + to_date.month - from_date.month)
@@ -0,0 +1,137 @@
+# This file is part of the cooperative_cashflow_ar module for Tryton.
+# The COPYRIGHT file at the top level of this repository contains
+# the full copyright notices and license terms.
+import logging
+import threading
+import time
+from contextlib import contextmanager
+
+from trytond.transaction import Transaction
+
+logger = logging.getLogger(__name__)
+
+_local = threading.local()
+_sqlite_logger = logging.getLogger('trytond.backend.sqlite.database')
+
+
+class Profiler(object):
+    """Wall time, SQL queries and rows fetched by phase of a report
+
+    The queries are counted on the connections of the transactions
+    instrumented while the profiler is active and the rows are added by the
+    fetch of the cursors. A phase measures only the queries and rows of its
+    thread."""
+
+    def __init__(self):
+        self.phases = []
+        self.queries = 0
+        self.rows = 0
+        self._lock = threading.Lock()
+        self._local = threading.local()
+
+    def _get_counters(self):
+        "Return the counters of the current thread"
+        counters = self._local
+        if not hasattr(counters, 'queries'):
+            counters.queries = counters.rows = 0
+        return counters
+
+    def add(self, queries=0, rows=0):
+        counters = self._get_counters()
+        counters.queries += queries
+        counters.rows += rows
+        # the sources may be fetched by many threads
+        with self._lock:
+            self.queries += queries
+            self.rows += rows
+
+    @contextmanager
+    def instrument(self):
+        "Count the queries executed on the connection of the transaction"
+        connection = Transaction().connection
+        if hasattr(connection, 'cursor_factory'):
+            factory = connection.cursor_factory
+            connection.cursor_factory = self._get_cursor_factory(factory)
+            try:
+                yield
+            finally:
+                connection.cursor_factory = factory
+        elif hasattr(connection, 'set_trace_callback'):
+            connection.set_trace_callback(self._trace)
+            try:
+                yield
+            finally:
+                connection.set_trace_callback(
+                    _sqlite_logger.debug
+                    if _sqlite_logger.isEnabledFor(logging.DEBUG) else None)
+        else:
+            yield
+
+    def _get_cursor_factory(self, factory):
+        profiler = self
+
+        class Cursor(factory):
+            def execute(self, query, vars=None):
+                profiler.add(queries=1)
+                return super().execute(query, vars)
+        return Cursor
+
+    def _trace(self, statement):
+        # SQLite traces also the transaction statements
+        words = statement.split(None, 1)
+        if words and words[0].upper() in {
+                'SELECT', 'INSERT', 'UPDATE', 'DELETE', 'WITH'}:
+            self.add(queries=1)
+        if _sqlite_logger.isEnabledFor(logging.DEBUG):
+            _sqlite_logger.debug(statement)
+
+    @contextmanager
+    def phase(self, name):
+        "Measure the block as the phase name"
+        counters = self._get_counters()
+        queries, rows = counters.queries, counters.rows
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            measure = {
+                'name': name,
+                'seconds': time.perf_counter() - start,
+                'queries': counters.queries - queries,
+                'rows': counters.rows - rows,
+                }
+            self.phases.append(measure)
+            logger.info("%(name)s: %(seconds).3fs, %(queries)s queries, "
+                "%(rows)s rows", measure)
+
+
+def current_profiler():
+    "Return the active profiler of the thread or None"
+    return getattr(_local, 'profiler', None)
+
+
+@contextmanager
+def activate(profiler):
+    """Make the profiler active in the thread and instrument the
+    transaction, nothing is done if profiler is None"""
+    if profiler is None:
+        yield
+        return
+    previous = current_profiler()
+    _local.profiler = profiler
+    try:
+        with profiler.instrument():
+            yield
+    finally:
+        _local.profiler = previous
+
+
+@contextmanager
+def phase(name):
+    "Measure the block as the phase name of the active profiler if any"
+    profiler = current_profiler()
+    if profiler is None:
+        yield
+    else:
+        with profiler.phase(name):
+            yield
@@ -2,7 +2,6 @@
 # The COPYRIGHT file at the top level of this repository contains
 # the full copyright notices and license terms.
 from decimal import Decimal
-from simpleeval import simple_eval
 
 from trytond.model import Workflow, ModelView, fields
 from trytond.model.exceptions import ValidationError
@@ -10,13 +9,20 @@ from trytond.wizard import Wizard, StateView, StateTransition, Button
 from trytond.pool import Pool, PoolMeta
 from trytond.pyson import Eval
 from trytond.i18n import gettext
-from trytond.tools import decistmt
 from trytond.modules.product import round_price
 
+from .formula import Formula, months_between
+
 
 class Purchase(metaclass=PoolMeta):
     __name__ = 'purchase.purchase'
 
+    @classmethod
+    def __register__(cls, module_name):
+        super().__register__(module_name)
+        table = cls.__table_handler__(module_name)
+        table.index_action(['company', 'state'], 'add')
+
     @classmethod
     def __setup__(cls):
         super().__setup__()
@@ -42,6 +48,80 @@ class Purchase(metaclass=PoolMeta):
     def project(cls, purchases):
         pass
 
+    @classmethod
+    def write(cls, *args):
+        pool = Pool()
+        PurchaseLine = pool.get('purchase.line')
+        Summary = pool.get('cooperative_ar.cashflow.summary')
+        actions = iter(args)
+        lines = []
+        for purchases, values in zip(actions, actions):
+            if values.keys() & {
+                    'company', 'currency', 'purchase_date', 'state'}:
+                lines.extend(l for p in purchases for l in p.lines)
+        keys = PurchaseLine._get_cashflow_keys(lines)
+        super().write(*args)
+        if lines:
+            # processing does not change the lines in the cash-flow
+            keys ^= PurchaseLine._get_cashflow_keys(
+                PurchaseLine.browse([l.id for l in lines]))
+            Summary.update('purchase', keys)
+
+
+class PurchaseLine(metaclass=PoolMeta):
+    __name__ = 'purchase.line'
+
+    @classmethod
+    def __register__(cls, module_name):
+        super().__register__(module_name)
+        table = cls.__table_handler__(module_name)
+        table.index_action(['delivery_date_store', 'purchase'], 'add')
+
+    @classmethod
+    def _get_cashflow_keys(cls, lines):
+        """Return the set of (company, date, line, values) of the lines in
+        the cash-flow, a line with the same key has the same amounts"""
+        return set((l.purchase.company.id,
+                l.delivery_date_store or l.purchase.purchase_date, l.id,
+                l.purchase.currency.id, l.quantity, l.unit_price,
+                tuple(sorted((e.root.id, e.account.id if e.account else None)
+                        for e in getattr(l, 'analytic_accounts', None) or [])))
+            for l in lines
+            if l.type == 'line' and l.purchase.state in
+            ['projected', 'confirmed', 'processing'])
+
+    @classmethod
+    def create(cls, vlist):
+        pool = Pool()
+        Summary = pool.get('cooperative_ar.cashflow.summary')
+        lines = super().create(vlist)
+        Summary.update('purchase', cls._get_cashflow_keys(lines))
+        return lines
+
+    @classmethod
+    def write(cls, *args):
+        pool = Pool()
+        Summary = pool.get('cooperative_ar.cashflow.summary')
+        actions = iter(args)
+        lines = []
+        for sub_lines, values in zip(actions, actions):
+            if values.keys() & {'purchase', 'type', 'quantity', 'unit_price',
+                    'delivery_date_store', 'analytic_accounts'}:
+                lines.extend(sub_lines)
+        keys = cls._get_cashflow_keys(lines)
+        super().write(*args)
+        if lines:
+            keys ^= cls._get_cashflow_keys(cls.browse([l.id for l in lines]))
+            Summary.update('purchase', keys)
+
+    @classmethod
+    def delete(cls, lines):
+        pool = Pool()
+        Summary = pool.get('cooperative_ar.cashflow.summary')
+        keys = cls._get_cashflow_keys(lines)
+        super().delete(lines)
+        Summary.update('purchase', keys)
+
 
 class UpdatePurchaseProjectionStart(ModelView):
     'Update Purchase Projection'
@@ -51,7 +131,11 @@ class UpdatePurchaseProjectionStart(ModelView):
         help='Delivery Date from which the prices will be updated')
     formula = fields.Char('Unit Price Formula', required=True,
         help=('Python expression that will be evaluated with:\n'
-            '- unit_price: the current unit price of each line'))
+            '- unit_price: the current unit price of each line\n'
+            '- delivery_date: the delivery date of the line\n'
+            '- months: the months from the From Date to the delivery date\n'
+            '- product: the code of the product\n'
+            '- partner: the code of the party'))
 
     @classmethod
     def default_from_date(cls):
@@ -90,6 +174,8 @@ class UpdatePurchaseProjection(Wizard):
 
     def check_formula(self):
         try:
+            self._formula = Formula(self.start.formula,
+                self._get_formula_names(None))
             if not isinstance(self.get_unit_price(Decimal(0)), Decimal):
                 raise ValueError
         except Exception as exception:
@@ -98,10 +184,29 @@ class UpdatePurchaseProjection(Wizard):
                 formula=self.start.formula,
                 exception=exception)) from exception
 
-    def get_unit_price(self, unit_price, **context):
-        context.setdefault('names', {})['unit_price'] = unit_price
-        context.setdefault('functions', {})['Decimal'] = Decimal
-        return simple_eval(decistmt(self.start.formula), **context)
+    def get_unit_price(self, unit_price, **names):
+        names = {**self._get_formula_names(None), **names}
+        names['unit_price'] = unit_price
+        return self._formula(**names)
+
+    def _get_formula_names(self, line):
+        "Return the names of the formula for the line or default values"
+        if line is None:
+            return {
+                'unit_price': Decimal(0),
+                'delivery_date': self.start.from_date,
+                'months': 0,
+                'product': '',
+                'partner': '',
+                }
+        return {
+            'unit_price': line.unit_price,
+            'delivery_date': line.delivery_date_store,
+            'months': months_between(
+                self.start.from_date, line.delivery_date_store),
+            'product': (line.product.code or '') if line.product else '',
+            'partner': line.purchase.party.code or '',
+            }
 
     def update_unit_price(self):
         pool = Pool()
@@ -117,7 +222,8 @@ class UpdatePurchaseProjection(Wizard):
                 if (not line.delivery_date_store or
                         self.start.from_date > line.delivery_date_store):
                     continue
-                unit_price = round_price(self.get_unit_price(line.unit_price))
+                unit_price = round_price(
+                    self._formula(**self._get_formula_names(line)))
                 line.unit_price = unit_price
                 line.amount = line.on_change_with_amount()
                 purchase_lines.append(line)
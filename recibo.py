@@ -1,8 +1,8 @@
 # This file is part of the cooperative_cashflow_ar module for Tryton.
 # The COPYRIGHT file at the top level of this repository contains
 # the full copyright notices and license terms.
+from collections import defaultdict
 from decimal import Decimal
-from simpleeval import simple_eval
 
 from trytond.model import Workflow, ModelView, fields
 from trytond.model.exceptions import ValidationError
@@ -10,12 +10,20 @@ from trytond.wizard import Wizard, StateView, StateTransition, Button
 from trytond.pool import Pool, PoolMeta
 from trytond.pyson import Eval
 from trytond.i18n import gettext
-from trytond.tools import decistmt
+from trytond.tools import grouped_slice
+
+from .formula import Formula, months_between
 
 
 class Recibo(metaclass=PoolMeta):
     __name__ = 'cooperative.partner.recibo'
 
+    @classmethod
+    def __register__(cls, module_name):
+        super().__register__(module_name)
+        table = cls.__table_handler__(module_name)
+        table.index_action(['company', 'state', 'date'], 'add')
+
     @classmethod
     def __setup__(cls):
         super().__setup__()
@@ -41,6 +49,48 @@ class Recibo(metaclass=PoolMeta):
     def project(cls, recibos):
         pass
 
+    @classmethod
+    def _get_cashflow_keys(cls, recibos):
+        """Return the set of (company, date, receipt, values) of the receipts
+        in the cash-flow, a receipt with the same key has the same amount"""
+        return set((r.company.id, r.date, r.id, r.currency.id,
+                r.partner.id if r.partner else None, r.amount)
+            for r in recibos
+            if r.state in ['projected', 'confirmed'])
+
+    @classmethod
+    def create(cls, vlist):
+        pool = Pool()
+        Summary = pool.get('cooperative_ar.cashflow.summary')
+        recibos = super().create(vlist)
+        Summary.update('receipt', cls._get_cashflow_keys(recibos))
+        return recibos
+
+    @classmethod
+    def write(cls, *args):
+        pool = Pool()
+        Summary = pool.get('cooperative_ar.cashflow.summary')
+        actions = iter(args)
+        recibos = []
+        for sub_recibos, values in zip(actions, actions):
+            if values.keys() & {'company', 'currency', 'partner', 'date',
+                    'amount', 'state'}:
+                recibos.extend(sub_recibos)
+        keys = cls._get_cashflow_keys(recibos)
+        super().write(*args)
+        if recibos:
+            keys ^= cls._get_cashflow_keys(
+                cls.browse([r.id for r in recibos]))
+            Summary.update('receipt', keys)
+
+    @classmethod
+    def delete(cls, recibos):
+        pool = Pool()
+        Summary = pool.get('cooperative_ar.cashflow.summary')
+        keys = cls._get_cashflow_keys(recibos)
+        super().delete(recibos)
+        Summary.update('receipt', keys)
+
 
 class ReciboLote(metaclass=PoolMeta):
     __name__ = 'cooperative.partner.recibo.lote'
@@ -70,8 +120,8 @@ class ReciboLote(metaclass=PoolMeta):
     def project(cls, lotes):
         pool = Pool()
         Recibo = pool.get('cooperative.partner.recibo')
-        for lote in lotes:
-            Recibo.project(lote.recibos)
+        for recibos in grouped_slice([r for l in lotes for r in l.recibos]):
+            Recibo.project(list(recibos))
 
     @classmethod
     @ModelView.button
@@ -80,8 +130,8 @@ class ReciboLote(metaclass=PoolMeta):
         pool = Pool()
         Recibo = pool.get('cooperative.partner.recibo')
         super().draft(lotes)
-        for lote in lotes:
-            Recibo.draft(lote.recibos)
+        for recibos in grouped_slice([r for l in lotes for r in l.recibos]):
+            Recibo.draft(list(recibos))
 
 
 class UpdateReciboLoteProjectionStart(ModelView):
@@ -90,13 +140,35 @@ class UpdateReciboLoteProjectionStart(ModelView):
 
     formula = fields.Char('Unit Price Formula', required=True,
         help=('Python expression that will be evaluated with:\n'
-            '- amount: the current amount of each receipt'))
+            '- amount: the current amount of each receipt\n'
+            '- delivery_date: the date of the receipt\n'
+            '- months: the months from today to the date of the receipt\n'
+            '- partner: the code of the partner'))
 
     @classmethod
     def default_formula(cls):
         return 'amount'
 
 
+class UpdateReciboLoteProjectionPreview(ModelView):
+    'Update Recibo Projection Preview'
+    __name__ = 'cooperative.lote.update_projection.preview'
+
+    lotes = fields.One2Many('cooperative.lote.update_projection.preview.lote',
+        None, 'Lotes', readonly=True)
+
+
+class UpdateReciboLoteProjectionPreviewLote(ModelView):
+    'Update Recibo Projection Preview Lote'
+    __name__ = 'cooperative.lote.update_projection.preview.lote'
+
+    lote = fields.Many2One('cooperative.partner.recibo.lote', 'Lote',
+        readonly=True)
+    recibos = fields.Integer('Receipts', readonly=True)
+    old_total = fields.Numeric('Old Total', digits=(16, 2), readonly=True)
+    new_total = fields.Numeric('New Total', digits=(16, 2), readonly=True)
+
+
 class UpdateReciboLoteProjection(Wizard):
     'Update Recibo Projection'
     __name__ = 'cooperative.lote.update_projection'
@@ -106,6 +178,13 @@ class UpdateReciboLoteProjection(Wizard):
     start = StateView('cooperative.lote.update_projection.start',
         'cooperative_cashflow_ar.lote_update_projection_start_view', [
             Button('Cancel', 'end', 'tryton-cancel'),
+            Button('Preview', 'preview', 'tryton-forward'),
+            Button('Update', 'update', 'tryton-ok', True),
+            ])
+    preview = StateView('cooperative.lote.update_projection.preview',
+        'cooperative_cashflow_ar.lote_update_projection_preview_view', [
+            Button('Cancel', 'end', 'tryton-cancel'),
+            Button('Back', 'start', 'tryton-back'),
             Button('Update', 'update', 'tryton-ok', True),
             ])
     update = StateTransition()
@@ -116,6 +195,25 @@ class UpdateReciboLoteProjection(Wizard):
             return 'start'
         return 'end'
 
+    def default_preview(self, fields):
+        self.check_formula()
+        totals = {}
+        for recibo, amount in self.get_amounts():
+            lote = getattr(recibo, self._get_lote_field())
+            if lote.id not in totals:
+                totals[lote.id] = {
+                    'lote': lote.id,
+                    'recibos': 0,
+                    'old_total': Decimal(0),
+                    'new_total': Decimal(0),
+                    }
+            totals[lote.id]['recibos'] += 1
+            totals[lote.id]['old_total'] += recibo.amount
+            totals[lote.id]['new_total'] += amount
+        return {
+            'lotes': list(totals.values()),
+            }
+
     def transition_update(self):
         self.check_formula()
         self.update_amount()
@@ -123,6 +221,8 @@ class UpdateReciboLoteProjection(Wizard):
 
     def check_formula(self):
         try:
+            self._formula = Formula(self.start.formula,
+                self._get_formula_names(None))
             if not isinstance(self.get_amount(Decimal(0)), Decimal):
                 raise ValueError
         except Exception as exception:
@@ -131,25 +231,63 @@ class UpdateReciboLoteProjection(Wizard):
                 formula=self.start.formula,
                 exception=exception)) from exception
 
-    def get_amount(self, amount, **context):
-        context.setdefault('names', {})['amount'] = amount
-        context.setdefault('functions', {})['Decimal'] = Decimal
-        return simple_eval(decistmt(self.start.formula), **context)
+    def get_amount(self, amount, **names):
+        names = {**self._get_formula_names(None), **names}
+        names['amount'] = amount
+        return self._formula(**names)
+
+    def _get_formula_names(self, recibo):
+        "Return the names of the formula for the receipt or default values"
+        pool = Pool()
+        Date = pool.get('ir.date')
+        today = Date.today()
+        if recibo is None:
+            return {
+                'amount': Decimal(0),
+                'delivery_date': today,
+                'months': 0,
+                'partner': '',
+                }
+        return {
+            'amount': recibo.amount,
+            'delivery_date': recibo.date,
+            'months': months_between(today, recibo.date),
+            'partner': recibo.partner.code or '',
+            }
+
+    @staticmethod
+    def _get_lote_field():
+        pool = Pool()
+        Lote = pool.get('cooperative.partner.recibo.lote')
+        return Lote.recibos.field
+
+    def get_amounts(self):
+        "Return the projected receipts of the lotes with their new amount"
+        pool = Pool()
+        Recibo = pool.get('cooperative.partner.recibo')
+
+        lote_field = self._get_lote_field()
+        recibos = Recibo.search([
+                (lote_field, 'in', [l.id for l in self.records]),
+                (lote_field + '.state', '=', 'projected'),
+                ('state', '=', 'projected'),
+                ])
+        amounts = self._formula.map(
+            self._get_formula_names(r) for r in recibos)
+        return [(r, a.quantize(Decimal(1) / 10 ** 2))
+            for r, a in zip(recibos, amounts)]
 
     def update_amount(self):
         pool = Pool()
         Recibo = pool.get('cooperative.partner.recibo')
 
-        for lote in self.records:
-            if lote.state != 'projected':
-                continue
-            recibos = []
-            for recibo in lote.recibos:
-                if recibo.state != 'projected':
-                    continue
-                amount = self.get_amount(recibo.amount).quantize(
-                    Decimal(1) / 10 ** 2)
-                recibo.amount = amount
-                recibos.append(recibo)
-            if recibos:
-                Recibo.save(recibos)
+        # receipts with the same new amount are written together
+        amounts = defaultdict(list)
+        for recibo, amount in self.get_amounts():
+            if amount != recibo.amount:
+                amounts[amount].append(recibo)
+        to_write = []
+        for amount, recibos in amounts.items():
+            to_write.extend((recibos, {'amount': amount}))
+        if to_write:
+            Recibo.write(*to_write)
@@ -1,8 +1,8 @@
 # This file is part of the cooperative_cashflow_ar module for Tryton.
 # The COPYRIGHT file at the top level of this repository contains
 # the full copyright notices and license terms.
+from collections import defaultdict
 from decimal import Decimal
-from simpleeval import simple_eval
 
 from trytond.model import Workflow, ModelView, fields
 from trytond.model.exceptions import ValidationError
@@ -10,13 +10,20 @@ from trytond.wizard import Wizard, StateView, StateTransition, Button
 from trytond.pool import Pool, PoolMeta
 from trytond.pyson import Eval
 from trytond.i18n import gettext
-from trytond.tools import decistmt
 from trytond.modules.product import round_price
 
+from .formula import Formula, months_between
+
 
 class Sale(metaclass=PoolMeta):
     __name__ = 'sale.sale'
 
+    @classmethod
+    def __register__(cls, module_name):
+        super().__register__(module_name)
+        table = cls.__table_handler__(module_name)
+        table.index_action(['company', 'state'], 'add')
+
     @classmethod
     def __setup__(cls):
         super().__setup__()
@@ -42,6 +49,78 @@ class Sale(metaclass=PoolMeta):
     def project(cls, sales):
         pass
 
+    @classmethod
+    def write(cls, *args):
+        pool = Pool()
+        SaleLine = pool.get('sale.line')
+        Summary = pool.get('cooperative_ar.cashflow.summary')
+        actions = iter(args)
+        lines = []
+        for sales, values in zip(actions, actions):
+            if values.keys() & {'company', 'currency', 'state'}:
+                lines.extend(l for s in sales for l in s.lines)
+        keys = SaleLine._get_cashflow_keys(lines)
+        super().write(*args)
+        if lines:
+            # processing or done do not change the lines in the cash-flow
+            keys ^= SaleLine._get_cashflow_keys(
+                SaleLine.browse([l.id for l in lines]))
+            Summary.update('sale', keys)
+
+
+class SaleLine(metaclass=PoolMeta):
+    __name__ = 'sale.line'
+
+    @classmethod
+    def __register__(cls, module_name):
+        super().__register__(module_name)
+        table = cls.__table_handler__(module_name)
+        table.index_action(['manual_delivery_date', 'sale'], 'add')
+
+    @classmethod
+    def _get_cashflow_keys(cls, lines):
+        """Return the set of (company, date, line, values) of the lines in
+        the cash-flow, a line with the same key has the same amounts"""
+        return set((l.sale.company.id, l.manual_delivery_date, l.id,
+                l.sale.currency.id, l.quantity, l.unit_price,
+                tuple(sorted((e.root.id, e.account.id if e.account else None)
+                        for e in l.analytic_accounts)))
+            for l in lines
+            if l.type == 'line' and l.sale.state in
+            ['projected', 'confirmed', 'processing', 'done'])
+
+    @classmethod
+    def create(cls, vlist):
+        pool = Pool()
+        Summary = pool.get('cooperative_ar.cashflow.summary')
+        lines = super().create(vlist)
+        Summary.update('sale', cls._get_cashflow_keys(lines))
+        return lines
+
+    @classmethod
+    def write(cls, *args):
+        pool = Pool()
+        Summary = pool.get('cooperative_ar.cashflow.summary')
+        actions = iter(args)
+        lines = []
+        for sub_lines, values in zip(actions, actions):
+            if values.keys() & {'sale', 'type', 'quantity', 'unit_price',
+                    'manual_delivery_date', 'analytic_accounts'}:
+                lines.extend(sub_lines)
+        keys = cls._get_cashflow_keys(lines)
+        super().write(*args)
+        if lines:
+            keys ^= cls._get_cashflow_keys(cls.browse([l.id for l in lines]))
+            Summary.update('sale', keys)
+
+    @classmethod
+    def delete(cls, lines):
+        pool = Pool()
+        Summary = pool.get('cooperative_ar.cashflow.summary')
+        keys = cls._get_cashflow_keys(lines)
+        super().delete(lines)
+        Summary.update('sale', keys)
+
 
 class UpdateSaleProjectionStart(ModelView):
     'Update Sale Projection'
@@ -51,7 +130,11 @@ class UpdateSaleProjectionStart(ModelView):
         help='Delivery Date from which the prices will be updated')
     formula = fields.Char('Unit Price Formula', required=True,
         help=('Python expression that will be evaluated with:\n'
-            '- unit_price: the current unit price of each line'))
+            '- unit_price: the current unit price of each line\n'
+            '- delivery_date: the delivery date of the line\n'
+            '- months: the months from the From Date to the delivery date\n'
+            '- product: the code of the product\n'
+            '- partner: the code of the party'))
 
     @classmethod
     def default_from_date(cls):
@@ -90,6 +173,8 @@ class UpdateSaleProjection(Wizard):
 
     def check_formula(self):
         try:
+            self._formula = Formula(self.start.formula,
+                self._get_formula_names(None))
             if not isinstance(self.get_unit_price(Decimal(0)), Decimal):
                 raise ValueError
         except Exception as exception:
@@ -98,28 +183,50 @@ class UpdateSaleProjection(Wizard):
                 formula=self.start.formula,
                 exception=exception)) from exception
 
-    def get_unit_price(self, unit_price, **context):
-        context.setdefault('names', {})['unit_price'] = unit_price
-        context.setdefault('functions', {})['Decimal'] = Decimal
-        return simple_eval(decistmt(self.start.formula), **context)
+    def get_unit_price(self, unit_price, **names):
+        names = {**self._get_formula_names(None), **names}
+        names['unit_price'] = unit_price
+        return self._formula(**names)
+
+    def _get_formula_names(self, line):
+        "Return the names of the formula for the line or default values"
+        if line is None:
+            return {
+                'unit_price': Decimal(0),
+                'delivery_date': self.start.from_date,
+                'months': 0,
+                'product': '',
+                'partner': '',
+                }
+        return {
+            'unit_price': line.unit_price,
+            'delivery_date': line.manual_delivery_date,
+            'months': months_between(
+                self.start.from_date, line.manual_delivery_date),
+            'product': (line.product.code or '') if line.product else '',
+            'partner': line.sale.party.code or '',
+            }
 
     def update_unit_price(self):
         pool = Pool()
         SaleLine = pool.get('sale.line')
 
-        for sale in self.records:
-            if sale.state != 'projected':
-                continue
-            sale_lines = []
-            for line in sale.lines:
-                if line.type != 'line':
-                    continue
-                if (not line.manual_delivery_date or
-                        self.start.from_date > line.manual_delivery_date):
-                    continue
-                unit_price = round_price(self.get_unit_price(line.unit_price))
-                line.unit_price = unit_price
-                line.amount = line.on_change_with_amount()
-                sale_lines.append(line)
-            if sale_lines:
-                SaleLine.save(sale_lines)
+        lines = SaleLine.search([
+                ('sale', 'in', [s.id for s in self.records]),
+                ('sale.state', '=', 'projected'),
+                ('type', '=', 'line'),
+                ('manual_delivery_date', '>=', self.start.from_date),
+                ])
+        # lines with the same new price are written together
+        prices = defaultdict(list)
+        unit_prices = self._formula.map(
+            self._get_formula_names(l) for l in lines)
+        for line, unit_price in zip(lines, unit_prices):
+            unit_price = round_price(unit_price)
+            if unit_price != line.unit_price:
+                prices[unit_price].append(line)
+        to_write = []
+        for unit_price, price_lines in prices.items():
+            to_write.extend((price_lines, {'unit_price': unit_price}))
+        if to_write:
+            SaleLine.write(*to_write)
@@ -0,0 +1,506 @@
+# This file is part of the cooperative_cashflow_ar module for Tryton.
+# The COPYRIGHT file at the top level of this repository contains
+# the full copyright notices and license terms.
+"""Benchmark of the cash-flow report on synthetic data
+
+The test database named by the DB_NAME environment variable (SQLite or
+PostgreSQL depending on TRYTOND_DATABASE_URI) is filled with random
+documents, the phases of the report and the update projection wizards are
+timed and the results are written as JSON. Everything is rolled back at
+the end.
+
+    DB_NAME=:memory: python -m \\
+        trytond.modules.cooperative_cashflow_ar.tests.benchmark \\
+        --sales 1000 --output results.json
+"""
+import argparse
+import datetime
+import json
+import logging
+import random
+import sys
+import time
+import tracemalloc
+from decimal import Decimal
+
+from dateutil.relativedelta import relativedelta
+
+from trytond import backend
+from trytond.pool import Pool
+from trytond.tests.test_tryton import DB_NAME, activate_module
+from trytond.transaction import Transaction
+
+logger = logging.getLogger(__name__)
+
+MODULE = 'cooperative_cashflow_ar'
+
+
+class QueryCounter(logging.Handler):
+    "Count the SQL queries logged by the database backends"
+    loggers = [
+        'trytond.backend.postgresql.database',
+        'trytond.backend.sqlite.database',
+        ]
+    keywords = {'SELECT', 'INSERT', 'UPDATE', 'DELETE', 'WITH'}
+
+    def __init__(self):
+        super().__init__(logging.DEBUG)
+        self.count = 0
+
+    def install(self):
+        # SQLite traces the queries only if the logger is enabled when the
+        # connection is created
+        for name in self.loggers:
+            logger_ = logging.getLogger(name)
+            logger_.setLevel(logging.DEBUG)
+            logger_.addHandler(self)
+            logger_.propagate = False
+
+    def emit(self, record):
+        query = record.msg
+        if isinstance(query, bytes):
+            query = query.decode('utf-8', 'replace')
+        if isinstance(query, str) and query.split(None, 1):
+            if query.split(None, 1)[0].upper() in self.keywords:
+                self.count += 1
+
+
+class Generator(object):
+    "Fill the database with random documents of the cash-flow sources"
+
+    def __init__(self, options):
+        self.options = options
+        self.random = random.Random(options.seed)
+        self.from_date = options.from_date
+        self.to_date = (options.from_date
+            + relativedelta(months=options.months, days=-1))
+
+    def date(self):
+        return self.from_date + datetime.timedelta(days=self.random.randint(
+                0, (self.to_date - self.from_date).days))
+
+    def amount(self, maximum=1000):
+        return Decimal(self.random.randint(100, maximum * 100)) / 100
+
+    def currency(self):
+        if self.random.random() < self.options.foreign:
+            return self.foreign
+        return self.company.currency
+
+    def choice(self, values):
+        return self.random.choice(values)
+
+    def batches(self, count, size=None):
+        "Yield the ranges of count items by batch of size"
+        size = size or self.options.batch
+        for start in range(0, count, size):
+            yield range(start, min(start + size, count))
+
+    def create_company(self):
+        from trytond.modules.company.tests import create_company
+        from trytond.modules.currency.tests import (
+            create_currency, add_currency_rate)
+
+        currency = create_currency('ARS')
+        add_currency_rate(currency, Decimal(1),
+            self.from_date - relativedelta(years=1))
+        self.foreign = create_currency('USD')
+        date = self.from_date - relativedelta(months=1)
+        rate = Decimal('0.012')
+        while date <= self.to_date:
+            add_currency_rate(self.foreign, rate, date)
+            rate = (rate * Decimal('0.97')).quantize(Decimal('0.000001'))
+            date += relativedelta(**{'%ss' % self.options.rates: 1})
+        self.company = create_company(currency=currency)
+        return self.company
+
+    def populate(self):
+        self.create_parties()
+        self.create_analytic_accounts()
+        self.create_sales()
+        self.create_purchases()
+        self.create_moves()
+        self.create_lotes()
+
+    def create_parties(self):
+        pool = Pool()
+        Party = pool.get('party.party')
+        self.parties = Party.create([{
+                    'name': 'Party %s' % i,
+                    'code': 'P%s' % i,
+                    'addresses': [('create', [{}])],
+                    } for i in range(self.options.parties)])
+
+    def create_analytic_accounts(self):
+        pool = Pool()
+        Account = pool.get('analytic_account.account')
+        self.root, = Account.create([{
+                    'name': 'Cash-Flow',
+                    'type': 'root',
+                    'company': self.company.id,
+                    }])
+        self.categories = Account.create([{
+                    'name': 'Category %s' % i,
+                    'type': 'normal',
+                    'company': self.company.id,
+                    'root': self.root.id,
+                    'parent': self.root.id,
+                    } for i in range(self.options.categories)])
+
+    def entries(self):
+        return [('create', [{
+                            'root': self.root.id,
+                            'account': self.choice(self.categories).id,
+                            }])]
+
+    def warehouse(self):
+        pool = Pool()
+        Location = pool.get('stock.location')
+        warehouse, = Location.search([('type', '=', 'warehouse')], limit=1)
+        return warehouse
+
+    def create_sales(self):
+        pool = Pool()
+        Sale = pool.get('sale.sale')
+        warehouse = self.warehouse()
+        for batch in self.batches(self.options.sales):
+            vlist = []
+            for _ in batch:
+                party = self.choice(self.parties)
+                vlist.append({
+                        'company': self.company.id,
+                        'party': party.id,
+                        'invoice_address': party.addresses[0].id,
+                        'shipment_address': party.addresses[0].id,
+                        'warehouse': warehouse.id,
+                        'currency': self.currency().id,
+                        'sale_date': self.from_date,
+                        'state': self.choice(['projected', 'confirmed']),
+                        'lines': [('create', [{
+                                        'type': 'line',
+                                        'description': 'Line %s' % i,
+                                        'quantity': self.random.randint(1, 10),
+                                        'unit_price': self.amount(),
+                                        'manual_delivery_date': self.date(),
+                                        'analytic_accounts': self.entries(),
+                                        }
+                                    for i in range(self.options.lines)])],
+                        })
+            Sale.create(vlist)
+
+    def create_purchases(self):
+        pool = Pool()
+        Purchase = pool.get('purchase.purchase')
+        warehouse = self.warehouse()
+        for batch in self.batches(self.options.purchases):
+            vlist = []
+            for _ in batch:
+                party = self.choice(self.parties)
+                vlist.append({
+                        'company': self.company.id,
+                        'party': party.id,
+                        'invoice_address': party.addresses[0].id,
+                        'warehouse': warehouse.id,
+                        'currency': self.currency().id,
+                        'purchase_date': self.from_date,
+                        'state': self.choice(['projected', 'confirmed']),
+                        'lines': [('create', [{
+                                        'type': 'line',
+                                        'description': 'Line %s' % i,
+                                        'quantity': self.random.randint(1, 10),
+                                        'unit_price': self.amount(),
+                                        'delivery_date_store': self.date(),
+                                        }
+                                    for i in range(self.options.lines)])],
+                        })
+            Purchase.create(vlist)
+
+    def create_moves(self):
+        "Create posted moves from cash to an account of the cash-flow"
+        pool = Pool()
+        Account = pool.get('account.account')
+        FiscalYear = pool.get('account.fiscalyear')
+        Journal = pool.get('account.journal')
+        Move = pool.get('account.move')
+        Period = pool.get('account.period')
+        from trytond.modules.account.tests import create_chart, get_fiscalyear
+
+        create_chart(self.company)
+        fiscalyear = get_fiscalyear(self.company, today=self.from_date,
+            start_date=self.from_date, end_date=self.to_date)
+        fiscalyear.save()
+        FiscalYear.create_period([fiscalyear])
+        expense, = Account.search([
+                ('type.expense', '=', True),
+                ('company', '=', self.company.id),
+                ], limit=1)
+        cash, = Account.search([
+                ('name', '=', 'Main Cash'),
+                ('company', '=', self.company.id),
+                ], limit=1)
+        Account.write([expense], {'cashflow_report': True})
+        journal, = Journal.search([('type', '=', 'expense')], limit=1)
+
+        for batch in self.batches(self.options.moves):
+            vlist = []
+            for _ in batch:
+                date = self.date()
+                amount = self.amount()
+                analytic_lines = [('create', [{
+                                'account': self.choice(self.categories).id,
+                                'debit': amount,
+                                'credit': Decimal(0),
+                                'date': date,
+                                }])]
+                vlist.append({
+                        'company': self.company.id,
+                        'journal': journal.id,
+                        'period': Period.find(self.company.id, date=date),
+                        'date': date,
+                        'lines': [('create', [{
+                                        'account': expense.id,
+                                        'debit': amount,
+                                        'credit': Decimal(0),
+                                        'analytic_lines': analytic_lines,
+                                        }, {
+                                        'account': cash.id,
+                                        'debit': Decimal(0),
+                                        'credit': amount,
+                                        }])],
+                        })
+            Move.post(Move.create(vlist))
+
+    def create_lotes(self):
+        "Create lotes of receipts, the half of them projected"
+        pool = Pool()
+        if not self.options.lotes:
+            return
+        Lote = pool.get('cooperative.partner.recibo.lote')
+        size = max(self.options.receipts // self.options.lotes, 1)
+        for batch in self.batches(self.options.lotes):
+            vlist = []
+            for i in batch:
+                projected = i % 2 == 0
+                values = {
+                    'recibos': [('create', [{
+                                    'company': self.company.id,
+                                    'partner': self.choice(self.parties).id,
+                                    'currency': self.currency().id,
+                                    'date': self.date(),
+                                    'amount': self.amount(),
+                                    'state': (
+                                        'projected' if projected
+                                        else 'confirmed'),
+                                    } for _ in range(size)])],
+                    }
+                if projected:
+                    values['state'] = 'projected'
+                vlist.append(values)
+            Lote.create(vlist)
+
+
+class Benchmark(object):
+    "Time, count the queries and the peak memory of each phase"
+
+    def __init__(self, options, counter):
+        self.options = options
+        self.counter = counter
+        self.results = []
+
+    def clear(self):
+        pool = Pool()
+        Report = pool.get('cooperative_ar.cashflow', type='report')
+        Report._cache.clear()
+        Transaction().cache.clear()
+
+    def measure(self, name, func):
+        seconds, queries = [], []
+        for _ in range(self.options.repeat):
+            self.clear()
+            count = self.counter.count
+            start = time.perf_counter()
+            func()
+            seconds.append(time.perf_counter() - start)
+            queries.append(self.counter.count - count)
+        peak = None
+        if self.options.memory:
+            # tracemalloc slows down the execution so it has its own run
+            self.clear()
+            tracemalloc.start()
+            try:
+                func()
+                _, peak = tracemalloc.get_traced_memory()
+            finally:
+                tracemalloc.stop()
+        result = {
+            'name': name,
+            'seconds': min(seconds),
+            'queries': max(queries),
+            'peak_memory': peak,
+            }
+        logger.info('%(name)s: %(seconds).3fs, %(queries)s queries, '
+            '%(peak_memory)s bytes', result)
+        self.results.append(result)
+        return result
+
+    def run(self, generator):
+        pool = Pool()
+        Report = pool.get('cooperative_ar.cashflow', type='report')
+        from ..cashflow import RateTable
+
+        data = {
+            'company': generator.company.id,
+            'analytic_account': generator.root.id,
+            'currency': generator.company.currency.id,
+            'from_date': generator.from_date,
+            'to_date': generator.to_date,
+            'granularity': self.options.granularity,
+            'format': 'ods',
+            }
+        columns = Report._get_date_columns(
+            data['from_date'], data['to_date'], data['granularity'])
+        rates = RateTable(data['from_date'], data['to_date'])
+        categories = Report._get_categories(data)
+
+        self.measure('rates', lambda: RateTable(
+                data['from_date'], data['to_date']))
+        self.measure('categories', lambda: Report._get_categories(data))
+        for source in Report._get_sources():
+            self.measure('records.%s' % source.name,
+                lambda source=source: self.pivot(
+                    data, columns, source, rates, categories))
+            self.measure('details.%s' % source.name,
+                lambda source=source: sum(1 for _ in Report._iter_details(
+                        data, source, rates, categories)))
+        self.measure('sections', lambda: Report._get_sections(data, columns))
+        self.measure('get_context', lambda: Report.get_context(
+                [], {}, data))
+        if data['granularity'] in {'month', 'quarter'}:
+            self.measure('get_context.summary', lambda: Report.get_context(
+                    [], {}, {**data, 'use_summary': True}))
+        self.measure('execute.ods', lambda: Report.execute([], data))
+        self.measure('execute.csv', lambda: Report.execute(
+                [], {**data, 'format': 'csv'}))
+
+        today = generator.from_date
+        self.measure('wizard.sale', lambda: self.wizard(
+                'sale.update_projection', 'sale.sale', [
+                    ('state', '=', 'projected')],
+                from_date=today, formula='unit_price * Decimal("1.01")'))
+        self.measure('wizard.purchase', lambda: self.wizard(
+                'purchase.update_projection', 'purchase.purchase', [
+                    ('state', '=', 'projected')],
+                from_date=today, formula='unit_price * Decimal("1.01")'))
+        self.measure('wizard.lote', lambda: self.wizard(
+                'cooperative.lote.update_projection',
+                'cooperative.partner.recibo.lote', [
+                    ('state', '=', 'projected')],
+                formula='amount * Decimal("1.01")'))
+
+    def pivot(self, data, columns, source, rates, categories):
+        pool = Pool()
+        Report = pool.get('cooperative_ar.cashflow', type='report')
+        pivot = Report._get_pivot(data, columns)
+        pivot.add_source(source.name, source.label, source.sign)
+        Report._add_source(data, pivot, source, rates, categories)
+        return pivot
+
+    def wizard(self, name, model, domain, **values):
+        "Run the update of the wizard on the records matching the domain"
+        pool = Pool()
+        Wizard = pool.get(name, type='wizard')
+        Model = pool.get(model)
+        records = Model.search(domain)
+        if not records:
+            return
+        session_id, _, _ = Wizard.create()
+        with Transaction().set_context(active_model=model,
+                active_id=records[0].id,
+                active_ids=[r.id for r in records]):
+            wizard = Wizard(session_id)
+            for field, value in values.items():
+                setattr(wizard.start, field, value)
+            wizard.transition_update()
+        Wizard.delete(session_id)
+
+
+def positive(value):
+    value = int(value)
+    if value < 1:
+        raise argparse.ArgumentTypeError("must be at least 1")
+    return value
+
+
+def parse_arguments(args=None):
+    parser = argparse.ArgumentParser(
+        description="Benchmark the cash-flow report on synthetic data")
+    parser.add_argument('--sales', type=int, default=100)
+    parser.add_argument('--purchases', type=int, default=100)
+    parser.add_argument('--lines', type=int, default=5,
+        help="lines per sale and purchase")
+    parser.add_argument('--moves', type=int, default=100)
+    parser.add_argument('--lotes', type=int, default=10)
+    parser.add_argument('--receipts', type=int, default=100)
+    parser.add_argument('--parties', type=int, default=50)
+    parser.add_argument('--categories', type=int, default=10)
+    parser.add_argument('--foreign', type=float, default=0.2,
+        help="ratio of the documents in foreign currency")
+    parser.add_argument('--rates', choices=['day', 'week', 'month'],
+        default='month', help="frequency of the currency rates")
+    parser.add_argument('--from-date', dest='from_date',
+        type=datetime.date.fromisoformat, default=datetime.date(2021, 1, 1))
+    parser.add_argument('--months', type=int, default=12)
+    parser.add_argument('--granularity',
+        choices=['day', 'week', 'month', 'quarter'], default='month')
+    parser.add_argument('--batch', type=int, default=100,
+        help="records created by call")
+    parser.add_argument('--repeat', type=positive, default=1,
+        help="runs of each phase, the fastest is kept")
+    parser.add_argument('--no-memory', dest='memory', action='store_false',
+        help="do not measure the peak memory")
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--output', default='-',
+        help="JSON file of the results")
+    return parser.parse_args(args)
+
+
+def main(args=None):
+    options = parse_arguments(args)
+    logging.basicConfig(level=logging.INFO, stream=sys.stderr)
+    counter = QueryCounter()
+    counter.install()
+    activate_module([MODULE])
+
+    from trytond.modules.company.tests import set_company
+
+    with Transaction().start(DB_NAME, 1) as transaction:
+        try:
+            generator = Generator(options)
+            company = generator.create_company()
+            with set_company(company):
+                start = time.perf_counter()
+                generator.populate()
+                generation = time.perf_counter() - start
+                logger.info('generation: %.3fs', generation)
+                benchmark = Benchmark(options, counter)
+                benchmark.run(generator)
+        finally:
+            transaction.rollback()
+
+    parameters = dict((k, str(v) if isinstance(v, datetime.date) else v)
+        for k, v in vars(options).items())
+    results = {
+        'backend': backend.name,
+        'parameters': parameters,
+        'generation': generation,
+        'results': benchmark.results,
+        }
+    if options.output == '-':
+        json.dump(results, sys.stdout, indent=2)
+    else:
+        with open(options.output, 'w') as file_:
+            json.dump(results, file_, indent=2)
+
+
+if __name__ == '__main__':
+    main()
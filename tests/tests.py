@@ -1,15 +1,948 @@
 # This file is part of Tryton.  The COPYRIGHT file at the top level of
 # this repository contains the full copyright notices and license terms.
+import csv
+import datetime
+import io
+import threading
 import unittest
+import zipfile
+from decimal import Decimal
 
-from trytond.tests.test_tryton import ModuleTestCase
+from trytond.pool import Pool
+from trytond.tests.test_tryton import ModuleTestCase, with_transaction
 from trytond.tests.test_tryton import suite as test_suite
+from trytond.transaction import Transaction
+
+from trytond.modules.account.tests import create_chart, get_fiscalyear
+from trytond.modules.company.tests import create_company, set_company
+from trytond.modules.currency.tests import create_currency, add_currency_rate
 
 
 class CooperativeCashflowArTestCase(ModuleTestCase):
     'Test Account Inflation Adjustment module'
     module = 'cooperative_cashflow_ar'
 
+    @with_transaction()
+    def test_rate_table(self):
+        'Test rate table gives the same result as currency compute'
+        pool = Pool()
+        Currency = pool.get('currency.currency')
+        from ..cashflow import RateTable
+
+        ars = create_currency('ARS')
+        usd = create_currency('USD')
+        add_currency_rate(ars, Decimal(1), datetime.date(2021, 1, 1))
+        add_currency_rate(usd, Decimal('0.012'), datetime.date(2020, 12, 1))
+        add_currency_rate(usd, Decimal('0.010'), datetime.date(2021, 2, 15))
+        add_currency_rate(usd, Decimal('0.008'), datetime.date(2021, 6, 1))
+
+        rates = RateTable(
+            datetime.date(2021, 1, 1), datetime.date(2021, 3, 31))
+        amount = Decimal('1234.56')
+        for date in [
+                datetime.date(2021, 1, 1),
+                datetime.date(2021, 2, 14),
+                datetime.date(2021, 2, 15),
+                datetime.date(2021, 3, 31),
+                ]:
+            with Transaction().set_context(date=date):
+                self.assertEqual(
+                    rates.compute(usd, amount, ars, date),
+                    Currency.compute(usd, amount, ars))
+        self.assertEqual(
+            rates.compute(ars, amount, ars, None), amount)
+
+    def _create_company(self):
+        "Create a company in ARS with rates of USD and analytic categories"
+        pool = Pool()
+        Account = pool.get('analytic_account.account')
+
+        ars = create_currency('ARS')
+        usd = create_currency('USD')
+        add_currency_rate(ars, Decimal(1), datetime.date(2020, 1, 1))
+        add_currency_rate(usd, Decimal('0.01'), datetime.date(2020, 1, 1))
+        add_currency_rate(usd, Decimal('0.008'), datetime.date(2021, 2, 1))
+        company = create_company(currency=ars)
+        root, = Account.create([{
+                    'name': 'Cash-Flow',
+                    'type': 'root',
+                    'company': company.id,
+                    }])
+        categories = Account.create([{
+                    'name': name,
+                    'type': 'normal',
+                    'company': company.id,
+                    'root': root.id,
+                    'parent': root.id,
+                    } for name in ['A', 'B']])
+        return company, usd, root, categories
+
+    def _create_party(self):
+        pool = Pool()
+        Party = pool.get('party.party')
+        party, = Party.create([{
+                    'name': 'Party',
+                    'addresses': [('create', [{}])],
+                    }])
+        return party
+
+    def _create_sale(self, company, currency, lines, state='confirmed'):
+        "Create a sale with lines of (delivery date, amount, category)"
+        pool = Pool()
+        Sale = pool.get('sale.sale')
+        Location = pool.get('stock.location')
+
+        party = self._create_party()
+        warehouse, = Location.search([('type', '=', 'warehouse')], limit=1)
+        sale, = Sale.create([{
+                    'company': company.id,
+                    'party': party.id,
+                    'invoice_address': party.addresses[0].id,
+                    'shipment_address': party.addresses[0].id,
+                    'warehouse': warehouse.id,
+                    'currency': currency.id,
+                    'sale_date': datetime.date(2021, 1, 1),
+                    'state': state,
+                    'lines': [('create', [{
+                                    'type': 'line',
+                                    'description': 'Line',
+                                    'quantity': 1,
+                                    'unit_price': amount,
+                                    'manual_delivery_date': date,
+                                    'analytic_accounts': [('create', [{
+                                                    'root': category.root.id,
+                                                    'account': category.id,
+                                                    }])] if category else [],
+                                    }
+                                for date, amount, category in lines])],
+                    }])
+        return sale
+
+    def _create_purchase(self, company, currency, lines, state='confirmed'):
+        "Create a purchase with lines of (delivery date, amount)"
+        pool = Pool()
+        Purchase = pool.get('purchase.purchase')
+        Location = pool.get('stock.location')
+
+        party = self._create_party()
+        warehouse, = Location.search([('type', '=', 'warehouse')], limit=1)
+        purchase, = Purchase.create([{
+                    'company': company.id,
+                    'party': party.id,
+                    'invoice_address': party.addresses[0].id,
+                    'warehouse': warehouse.id,
+                    'currency': currency.id,
+                    'purchase_date': datetime.date(2021, 1, 1),
+                    'state': state,
+                    'lines': [('create', [{
+                                    'type': 'line',
+                                    'description': 'Line',
+                                    'quantity': 1,
+                                    'unit_price': amount,
+                                    'delivery_date_store': date,
+                                    } for date, amount in lines])],
+                    }])
+        return purchase
+
+    def _create_moves(self, company, lines, post=True):
+        """Create moves from the cash to the expense account of the cash-flow
+        with lines of (date, amount, category)"""
+        pool = Pool()
+        Account = pool.get('account.account')
+        FiscalYear = pool.get('account.fiscalyear')
+        Journal = pool.get('account.journal')
+        Move = pool.get('account.move')
+        Period = pool.get('account.period')
+
+        if not FiscalYear.search([('company', '=', company.id)]):
+            create_chart(company)
+            fiscalyear = get_fiscalyear(company,
+                today=datetime.date(2021, 1, 1))
+            fiscalyear.save()
+            FiscalYear.create_period([fiscalyear])
+        expense, = Account.search([
+                ('type.expense', '=', True),
+                ('company', '=', company.id),
+                ], limit=1)
+        cash, = Account.search([
+                ('name', '=', 'Main Cash'),
+                ('company', '=', company.id),
+                ], limit=1)
+        Account.write([expense], {'cashflow_report': True})
+        journal, = Journal.search([('type', '=', 'expense')], limit=1)
+        moves = Move.create([{
+                    'company': company.id,
+                    'journal': journal.id,
+                    'period': Period.find(company.id, date=date),
+                    'date': date,
+                    'lines': [('create', [{
+                                    'account': expense.id,
+                                    'debit': amount,
+                                    'credit': Decimal(0),
+                                    'analytic_lines': [('create', [{
+                                                    'account': category.id,
+                                                    'debit': amount,
+                                                    'credit': Decimal(0),
+                                                    'date': date,
+                                                    }])],
+                                    }, {
+                                    'account': cash.id,
+                                    'debit': Decimal(0),
+                                    'credit': amount,
+                                    }])],
+                    } for date, amount, category in lines])
+        if post:
+            Move.post(moves)
+        return moves
+
+    def _create_lotes(self, company, currency, lotes, state='confirmed'):
+        "Create lotes of receipts with lines of (date, amount)"
+        pool = Pool()
+        Lote = pool.get('cooperative.partner.recibo.lote')
+
+        party = self._create_party()
+        return Lote.create([{
+                    'recibos': [('create', [{
+                                    'company': company.id,
+                                    'partner': party.id,
+                                    'currency': currency.id,
+                                    'date': date,
+                                    'amount': amount,
+                                    'state': state,
+                                    } for date, amount in recibos])],
+                    } for recibos in lotes])
+
+    def _run_tasks(self):
+        "Run the tasks queued by the transaction"
+        pool = Pool()
+        Queue = pool.get('ir.queue')
+        transaction = Transaction()
+        while transaction.tasks:
+            Queue(transaction.tasks.pop()).run()
+
+    @with_transaction()
+    def test_fetch_sale_currency(self):
+        'Test sale amounts in another currency are converted at their date'
+        pool = Pool()
+        Report = pool.get('cooperative_ar.cashflow', type='report')
+        from ..cashflow import RateTable
+
+        company, usd, root, _ = self._create_company()
+        jan, feb = datetime.date(2021, 1, 1), datetime.date(2021, 2, 1)
+        with set_company(company):
+            self._create_sale(company, usd, [
+                    (datetime.date(2021, 1, 15), Decimal(20), None),
+                    (datetime.date(2021, 2, 15), Decimal(20), None),
+                    ])
+            data = {
+                'company': company.id,
+                'analytic_account': root.id,
+                'currency': company.currency.id,
+                'from_date': jan,
+                'to_date': datetime.date(2021, 12, 31),
+                }
+            rates = RateTable(data['from_date'], data['to_date'])
+
+            self.assertEqual(
+                [(r[1], r[4], r[5], r[6])
+                    for r in Report._fetch_sale(data, rates)], [
+                    (jan, usd.id, Decimal(20), Decimal(2000)),
+                    (feb, usd.id, Decimal(20), Decimal(2500)),
+                    ])
+
+    @with_transaction()
+    def test_fetch_sources(self):
+        'Test the amounts fetched for each source of the cash-flow'
+        pool = Pool()
+        Report = pool.get('cooperative_ar.cashflow', type='report')
+        from ..cashflow import RateTable
+
+        company, usd, root, (a, b) = self._create_company()
+        ars = company.currency
+        jan, feb, mar, apr, may = (
+            datetime.date(2021, m, 1) for m in range(1, 6))
+        with set_company(company):
+            self._create_sale(company, usd, [
+                    (datetime.date(2021, 1, 15), Decimal(20), a),
+                    ])
+            self._create_sale(company, ars, [
+                    (datetime.date(2021, 2, 10), Decimal(100), b),
+                    (datetime.date(2021, 2, 20), Decimal(50), b),
+                    ])
+            self._create_sale(company, ars, [
+                    (datetime.date(2021, 1, 10), Decimal(999), a),
+                    ], state='draft')
+            self._create_purchase(company, ars, [
+                    (datetime.date(2021, 3, 5), Decimal(40)),
+                    ])
+            self._create_purchase(company, ars, [
+                    (datetime.date(2021, 3, 5), Decimal(999)),
+                    ], state='draft')
+            self._create_moves(company, [
+                    (datetime.date(2021, 4, 10), Decimal(30), a),
+                    ])
+            self._create_moves(company, [
+                    (datetime.date(2021, 4, 10), Decimal(999), a),
+                    ], post=False)
+            lote, = self._create_lotes(company, ars, [
+                    [(datetime.date(2021, 5, 3), Decimal(25))],
+                    ])
+            self._create_lotes(company, ars, [
+                    [(datetime.date(2021, 5, 3), Decimal(999))],
+                    ], state='draft')
+            party = lote.recibos[0].partner
+
+            data = {
+                'company': company.id,
+                'analytic_account': root.id,
+                'currency': ars.id,
+                'from_date': jan,
+                'to_date': datetime.date(2021, 12, 31),
+                }
+            rates = RateTable(data['from_date'], data['to_date'])
+
+            def fetch(source, data=data):
+                return [r[1:] for r in getattr(
+                        Report, '_fetch_%s' % source)(data, rates)]
+
+            self.assertEqual(fetch('sale'), [
+                    (jan, a.id, None, usd.id, Decimal(20), Decimal(2000)),
+                    (feb, b.id, None, ars.id, Decimal(150), Decimal(150)),
+                    ])
+            self.assertEqual(fetch('purchase'), [
+                    (mar, None, None, ars.id, Decimal(40), Decimal(40)),
+                    ])
+            self.assertEqual(fetch('expense'), [
+                    (apr, a.id, None, ars.id, Decimal(30), Decimal(30)),
+                    ])
+            self.assertEqual(fetch('receipt'), [
+                    (may, None, party.id, ars.id, Decimal(25), Decimal(25)),
+                    ])
+
+            # the amounts in the company currency are converted at their
+            # date to the report currency
+            self.assertEqual(
+                sorted(fetch('sale', {**data, 'currency': usd.id})), [
+                    (jan, a.id, None, usd.id, Decimal(20), Decimal(20)),
+                    (feb, b.id, None, ars.id, Decimal(50), Decimal('0.40')),
+                    (feb, b.id, None, ars.id, Decimal(100),
+                        Decimal('0.80')),
+                    ])
+
+    @with_transaction()
+    def test_fetch_purchase_dates(self):
+        'Test the purchase lines without delivery date use the purchase date'
+        pool = Pool()
+        Report = pool.get('cooperative_ar.cashflow', type='report')
+        from ..cashflow import RateTable
+
+        company, _, root, _ = self._create_company()
+        ars = company.currency
+        with set_company(company):
+            # the purchase date is the 1st of January
+            self._create_purchase(company, ars, [
+                    (None, Decimal(10)),
+                    (datetime.date(2021, 3, 5), Decimal(40)),
+                    (datetime.date(2022, 1, 5), Decimal(99)),
+                    ])
+            data = {
+                'company': company.id,
+                'analytic_account': root.id,
+                'currency': ars.id,
+                'from_date': datetime.date(2021, 1, 1),
+                'to_date': datetime.date(2021, 12, 31),
+                }
+            rates = RateTable(data['from_date'], data['to_date'])
+
+            self.assertEqual(
+                [(r[1], r[-1]) for r in Report._fetch_purchase(data, rates)],
+                [
+                    (datetime.date(2021, 1, 1), Decimal(10)),
+                    (datetime.date(2021, 3, 1), Decimal(40)),
+                    ])
+
+    @with_transaction()
+    def test_summary(self):
+        'Test the summary is updated with the sale lines'
+        pool = Pool()
+        Report = pool.get('cooperative_ar.cashflow', type='report')
+        Sale = pool.get('sale.sale')
+        SaleLine = pool.get('sale.line')
+        Summary = pool.get('cooperative_ar.cashflow.summary')
+        from ..cashflow import RateTable
+
+        company, _, root, (a, b) = self._create_company()
+        with set_company(company):
+            # in the company currency the sources are also grouped by month
+            sale = self._create_sale(company, company.currency, [
+                    (datetime.date(2021, 1, 15), Decimal(20), a),
+                    (datetime.date(2021, 2, 10), Decimal(10), b),
+                    (datetime.date(2021, 2, 20), Decimal(30), b),
+                    ])
+            data = {
+                'company': company.id,
+                'analytic_account': root.id,
+                'currency': company.currency.id,
+                'from_date': datetime.date(2021, 1, 1),
+                'to_date': datetime.date(2021, 12, 31),
+                }
+            rates = RateTable(data['from_date'], data['to_date'])
+
+            def check():
+                self._run_tasks()
+                self.assertEqual(
+                    sorted(Summary.fetch(data, 'sale', rates)),
+                    sorted(Report._fetch_sale(data, rates)))
+
+            check()
+            line = sale.lines[1]
+            SaleLine.write([line], {'unit_price': Decimal(15)})
+            check()
+            SaleLine.write([line], {
+                    'manual_delivery_date': datetime.date(2021, 3, 1),
+                    })
+            check()
+            Sale.draft([sale])
+            check()
+            SaleLine.delete([line])
+            Sale.write([sale], {'state': 'confirmed'})
+            check()
+            Summary.rebuild([company.id])
+            check()
+
+    @with_transaction()
+    def test_summary_roots(self):
+        'Test the summary of the receipts and of many roots'
+        pool = Pool()
+        AnalyticAccount = pool.get('analytic_account.account')
+        Report = pool.get('cooperative_ar.cashflow', type='report')
+        Summary = pool.get('cooperative_ar.cashflow.summary')
+        from ..cashflow import RateTable
+
+        company, _, root, (a, _) = self._create_company()
+        ars = company.currency
+        with set_company(company):
+            self._create_sale(company, ars, [
+                    (datetime.date(2021, 1, 15), Decimal(20), a),
+                    ])
+            self._create_lotes(company, ars, [
+                    [(datetime.date(2021, 1, 20), Decimal(25))],
+                    ])
+            self._run_tasks()
+            other, = AnalyticAccount.create([{
+                        'name': 'Other',
+                        'type': 'root',
+                        'company': company.id,
+                        }])
+            self._run_tasks()
+            data = {
+                'company': company.id,
+                'analytic_account': None,
+                'analytic_accounts': [root.id, other.id],
+                'currency': ars.id,
+                'from_date': datetime.date(2021, 1, 1),
+                'to_date': datetime.date(2021, 12, 31),
+                'use_summary': True,
+                }
+            rates = RateTable(data['from_date'], data['to_date'])
+
+            # the receipts are summarized once for all the roots
+            self.assertEqual(
+                [r[-1] for r in Report._fetch(data, 'receipt', rates)],
+                [Decimal(25)])
+            # the new root has the lines without category
+            self.assertEqual(
+                [r[2:] for r in Summary.fetch(
+                        {**data, 'analytic_accounts': [other.id]},
+                        'sale', rates)],
+                [(None, None, ars.id, Decimal(20), Decimal(20))])
+            # the categories of many roots are read from the documents
+            self.assertFalse(Summary.can_fetch(data, 'sale'))
+            self.assertEqual(
+                list(Report._fetch(data, 'sale', rates)),
+                list(Report._fetch_sale(data, rates)))
+
+    @with_transaction()
+    def test_summary_rate(self):
+        'Test the summary is updated with the rates'
+        pool = Pool()
+        Summary = pool.get('cooperative_ar.cashflow.summary')
+
+        company, usd, _, (a, _) = self._create_company()
+        with set_company(company):
+            self._create_sale(company, usd, [
+                    (datetime.date(2021, 3, 15), Decimal(20), a),
+                    ])
+            self._run_tasks()
+            summary, = Summary.search([('source', '=', 'sale')])
+            self.assertEqual(summary.company_amount, Decimal(2500))
+
+            add_currency_rate(
+                usd, Decimal('0.005'), datetime.date(2021, 3, 1))
+            self._run_tasks()
+            summary, = Summary.search([('source', '=', 'sale')])
+            self.assertEqual(summary.company_amount, Decimal(4000))
+
+    @with_transaction()
+    def test_cache_clear(self):
+        'Test the cached reports are cleared by the changes'
+        pool = Pool()
+        Account = pool.get('account.account')
+        Move = pool.get('account.move')
+        Rate = pool.get('currency.currency.rate')
+        Report = pool.get('cooperative_ar.cashflow', type='report')
+        SaleLine = pool.get('sale.line')
+
+        company, usd, _, (a, _) = self._create_company()
+        with set_company(company):
+            sale = self._create_sale(company, company.currency, [
+                    (datetime.date(2021, 1, 15), Decimal(20), a),
+                    ])
+            self._run_tasks()
+
+            Report._cache.set('report', True)
+            SaleLine.write(list(sale.lines), {'unit_price': Decimal(30)})
+            self._run_tasks()
+            self.assertIsNone(Report._cache.get('report'))
+
+            move, = self._create_moves(company, [
+                    (datetime.date(2021, 1, 10), Decimal(10), a),
+                    ], post=False)
+            cash, = Account.search([
+                    ('name', '=', 'Main Cash'),
+                    ('company', '=', company.id),
+                    ])
+            Report._cache.set('report', True)
+            Account.write([cash], {'cashflow_balance': True})
+            self.assertIsNone(Report._cache.get('report'))
+
+            Report._cache.set('report', True)
+            Move.post([move])
+            self.assertIsNone(Report._cache.get('report'))
+
+            Report._cache.set('report', True)
+            rate = add_currency_rate(
+                usd, Decimal('0.005'), datetime.date(2021, 3, 1))
+            self.assertIsNone(Report._cache.get('report'))
+
+            Report._cache.set('report', True)
+            Rate.write([rate], {'rate': Decimal('0.004')})
+            self.assertIsNone(Report._cache.get('report'))
+
+            Report._cache.set('report', True)
+            Rate.delete([rate])
+            self.assertIsNone(Report._cache.get('report'))
+
+    @with_transaction()
+    def test_report_details(self):
+        'Test the details are rendered but not cached'
+        pool = Pool()
+        Report = pool.get('cooperative_ar.cashflow', type='report')
+
+        company, _, root, (a, b) = self._create_company()
+        with set_company(company):
+            self._create_sale(company, company.currency, [
+                    (datetime.date(2021, 1, 15), Decimal(20), a),
+                    (datetime.date(2021, 1, 25), Decimal(5), a),
+                    (datetime.date(2021, 2, 10), Decimal(10), b),
+                    ])
+            data = {
+                'company': company.id,
+                'analytic_account': root.id,
+                'currency': company.currency.id,
+                'from_date': datetime.date(2021, 1, 1),
+                'to_date': datetime.date(2021, 12, 31),
+                'details': True,
+                'details_limit': 1,
+                }
+
+            context = Report.get_context([], {}, data)
+            self.assertEqual(
+                [(r['column'], r['amount']) for r in context['sales_raw']],
+                [('1/2021', Decimal(25))])
+            sections = Report._cache.get(Report._get_cache_key(data))
+            self.assertNotIn('sales_raw', sections)
+            self.assertEqual(
+                [r['total'] for r in sections['sales_summary']],
+                [Decimal(25), Decimal(10)])
+
+            # the consolidated records are told apart by their company
+            context = Report.get_context([], {}, {
+                    **data,
+                    'analytic_account': None,
+                    'companies': [company.id],
+                    'analytic_accounts': [root.id],
+                    })
+            self.assertEqual(
+                [r['company'] for r in context['sales_raw']],
+                [company.rec_name])
+
+            context = Report.get_context([], {}, {**data, 'details': False})
+            self.assertEqual(list(context['sales_raw']), [])
+
+            oext, content, _, _ = Report.execute([], data)
+            self.assertEqual(oext, 'ods')
+            self.assertTrue(content)
+
+            # the records of the weeks of a month are not merged
+            context = Report.get_context([], {}, {
+                    **data,
+                    'granularity': 'week',
+                    'details_limit': None,
+                    })
+            self.assertEqual(
+                [(r['column'], r['amount']) for r in context['sales_raw']], [
+                    ('11/01/2021', Decimal(20)),
+                    ('25/01/2021', Decimal(5)),
+                    ('08/02/2021', Decimal(10)),
+                    ])
+
+    @with_transaction()
+    def test_report_csv(self):
+        'Test the CSV files have the sections of the report'
+        pool = Pool()
+        Report = pool.get('cooperative_ar.cashflow', type='report')
+
+        company, _, root, (a, b) = self._create_company()
+        with set_company(company):
+            self._create_sale(company, company.currency, [
+                    (datetime.date(2021, 1, 15), Decimal(20), a),
+                    (datetime.date(2021, 1, 25), Decimal(5), a),
+                    (datetime.date(2021, 2, 10), Decimal(10), b),
+                    ])
+            data = {
+                'company': company.id,
+                'analytic_account': root.id,
+                'currency': company.currency.id,
+                'from_date': datetime.date(2021, 1, 1),
+                'to_date': datetime.date(2021, 3, 31),
+                'format': 'csv',
+                }
+
+            oext, content, _, _ = Report.execute([], data)
+            self.assertEqual(oext, 'zip')
+
+            def read(zip_, name):
+                with zip_.open(name) as file_:
+                    return list(csv.reader(
+                            io.TextIOWrapper(file_, encoding='utf-8')))
+
+            with zipfile.ZipFile(io.BytesIO(content)) as zip_:
+                self.assertEqual(read(zip_, 'sales_summary.csv'), [
+                        ['category', '1/2021', '2/2021', '3/2021', 'Total'],
+                        [a.name, '25.00', '', '', '25.00'],
+                        [b.name, '', '10.00', '', '10.00'],
+                        ])
+                # the details are summed like in the sheets
+                self.assertEqual(read(zip_, 'sales_detail.csv')[1:], [
+                        ['1/2021', company.rec_name, '2021-01-01', '',
+                            a.name, '25.00'],
+                        ['2/2021', company.rec_name, '2021-02-01', '',
+                            b.name, '10.00'],
+                        ])
+                self.assertEqual(
+                    read(zip_, 'synthesis.csv')[0],
+                    ['', '1/2021', '2/2021', '3/2021', 'Total'])
+
+    @with_transaction()
+    def test_update_sale_projection(self):
+        'Test the update of the projected sale prices'
+        pool = Pool()
+        UpdateProjection = pool.get('sale.update_projection', type='wizard')
+
+        company, _, _, (a, _) = self._create_company()
+        with set_company(company):
+            sale = self._create_sale(company, company.currency, [
+                    (datetime.date(2021, 1, 15), Decimal(10), a),
+                    (datetime.date(2021, 3, 15), Decimal(10), a),
+                    ], state='projected')
+            session_id, _, _ = UpdateProjection.create()
+            with Transaction().set_context(active_model='sale.sale',
+                    active_id=sale.id, active_ids=[sale.id]):
+                update = UpdateProjection(session_id)
+                update.start.from_date = datetime.date(2021, 2, 1)
+                update.start.formula = 'unit_price * 2'
+                update.transition_update()
+
+            self.assertEqual([l.unit_price for l in sale.lines],
+                [Decimal(10), Decimal(20)])
+
+    @with_transaction()
+    def test_lote_project_draft(self):
+        'Test the receipts of all the lotes are projected and drafted'
+        pool = Pool()
+        Lote = pool.get('cooperative.partner.recibo.lote')
+
+        company, _, _, _ = self._create_company()
+        with set_company(company):
+            lotes = self._create_lotes(company, company.currency, [
+                    [(datetime.date(2021, 1, 15), Decimal(10)),
+                        (datetime.date(2021, 2, 15), Decimal(20))],
+                    [(datetime.date(2021, 3, 15), Decimal(30))],
+                    ], state='draft')
+            Lote.project(lotes)
+            self.assertEqual(
+                [r.state for l in lotes for r in l.recibos],
+                ['projected'] * 3)
+
+            Lote.draft(lotes)
+            self.assertEqual(
+                [r.state for l in lotes for r in l.recibos], ['draft'] * 3)
+
+    @with_transaction()
+    def test_lote_update_projection(self):
+        'Test the update of the projected receipts of many lotes'
+        pool = Pool()
+        Lote = pool.get('cooperative.partner.recibo.lote')
+        UpdateProjection = pool.get(
+            'cooperative.lote.update_projection', type='wizard')
+
+        company, _, _, _ = self._create_company()
+        with set_company(company):
+            lotes = self._create_lotes(company, company.currency, [
+                    [(datetime.date(2021, 1, 15), Decimal(10)),
+                        (datetime.date(2021, 2, 15), Decimal(20))],
+                    [(datetime.date(2021, 3, 15), Decimal(30))],
+                    ], state='draft')
+            Lote.project(lotes)
+
+            session_id, _, _ = UpdateProjection.create()
+            with Transaction().set_context(
+                    active_model='cooperative.partner.recibo.lote',
+                    active_id=lotes[0].id,
+                    active_ids=[l.id for l in lotes]):
+                update = UpdateProjection(session_id)
+                update.start.formula = 'amount * 2'
+                preview = update.default_preview(None)
+                self.assertEqual(sorted(
+                        (p['lote'], p['recibos'], p['old_total'],
+                            p['new_total']) for p in preview['lotes']), [
+                        (lotes[0].id, 2, Decimal(30), Decimal(60)),
+                        (lotes[1].id, 1, Decimal(30), Decimal(60)),
+                        ])
+                self.assertEqual(
+                    [r.amount for l in lotes for r in l.recibos],
+                    [Decimal(10), Decimal(20), Decimal(30)])
+
+                update.transition_update()
+            self.assertEqual(
+                [r.amount for l in lotes for r in l.recibos],
+                [Decimal(20), Decimal(40), Decimal(60)])
+
+    @with_transaction()
+    def test_scenario(self):
+        'Test the scenario formulas are applied to the amount of the column'
+        pool = Pool()
+        Report = pool.get('cooperative_ar.cashflow', type='report')
+        Scenario = pool.get('cooperative_ar.cashflow.scenario')
+
+        company, _, root, (a, b) = self._create_company()
+        with set_company(company):
+            self._create_sale(company, company.currency, [
+                    (datetime.date(2021, 1, 10), Decimal(10), a),
+                    (datetime.date(2021, 1, 20), Decimal(30), b),
+                    ], state='projected')
+            scenario, = Scenario.create([{
+                        'name': 'Plus',
+                        'sale_formula': 'amount + 5',
+                        }])
+            data = {
+                'company': company.id,
+                'analytic_account': root.id,
+                'currency': company.currency.id,
+                'from_date': datetime.date(2021, 1, 1),
+                'to_date': datetime.date(2021, 2, 28),
+                'scenarios': [scenario.id],
+                'details': False,
+                }
+
+            context = Report.get_context([], {}, data)
+            result, = [r for r in context['synthesis']
+                if r['name'] == 'Resultado Plus']
+            self.assertEqual(result['columns'],
+                [Decimal(45), None, Decimal(45)])
+
+    def test_pivot(self):
+        'Test pivot of the cash-flow amounts'
+        from ..cashflow import Pivot, CashFlowReport
+
+        columns = CashFlowReport._get_date_columns(
+            datetime.date(2021, 1, 15), datetime.date(2021, 3, 10))
+        jan, feb, mar = (datetime.date(2021, m, 1) for m in [1, 2, 3])
+        pivot = Pivot(columns, 2)
+        pivot.add_source('sale', 'Sales', 1)
+        pivot.add('sale', 1, 'A', jan, Decimal('10.50'))
+        pivot.add('sale', 1, 'A', mar, Decimal('1.25'))
+        pivot.add_source('expense', 'Expenses', -1)
+        pivot.add('expense', 2, 'B', feb, Decimal('5.10'))
+
+        self.assertEqual(pivot.summary('sale', 'category'), [{
+                    'category': 'A',
+                    'columns': [
+                        Decimal('10.50'), None, Decimal('1.25'),
+                        Decimal('11.75')],
+                    'total': Decimal('11.75'),
+                    }])
+        self.assertEqual(pivot.synthesis('Result'), [{
+                    'name': 'Sales',
+                    'columns': [
+                        Decimal('10.50'), None, Decimal('1.25'),
+                        Decimal('11.75')],
+                    }, {
+                    'name': 'Expenses',
+                    'columns': [None, Decimal('5.10'), None, Decimal('5.10')],
+                    }, {
+                    'name': 'Result',
+                    'columns': [
+                        Decimal('10.50'), Decimal('-5.10'), Decimal('1.25'),
+                        Decimal('6.65')],
+                    }])
+
+    def test_date_columns(self):
+        'Test date columns by granularity'
+        from ..cashflow import CashFlowReport
+
+        from_date = datetime.date(2021, 2, 3)
+        to_date = datetime.date(2021, 4, 1)
+        for granularity, count, first in [
+                ('day', 58, from_date),
+                ('week', 9, datetime.date(2021, 2, 1)),
+                ('month', 3, datetime.date(2021, 2, 1)),
+                ('quarter', 2, datetime.date(2021, 1, 1)),
+                ]:
+            columns = CashFlowReport._get_date_columns(
+                from_date, to_date, granularity)
+            self.assertEqual(len(columns), count)
+            self.assertEqual(next(iter(columns)), first)
+            self.assertEqual(CashFlowReport._get_bucket(
+                    datetime.date(2021, 3, 31), granularity) in columns,
+                True)
+
+    def test_pivot_groups(self):
+        'Test pivot result by group'
+        from ..cashflow import Pivot, CashFlowReport
+
+        columns = CashFlowReport._get_date_columns(
+            datetime.date(2021, 1, 1), datetime.date(2021, 2, 28))
+        jan, feb = datetime.date(2021, 1, 1), datetime.date(2021, 2, 1)
+        pivot = Pivot(columns, 2)
+        pivot.add_group(1, 'A')
+        pivot.add_group(2, 'B')
+        pivot.add_source('sale', 'Sales', 1)
+        pivot.add_source('expense', 'Expenses', -1)
+        pivot.add('sale', 'X', 'X', jan, Decimal(10), group=1)
+        pivot.add('sale', 'X', 'X', feb, Decimal(5), group=2)
+        pivot.add('expense', 'Y', 'Y', feb, Decimal(3), group=2)
+        pivot.add_scenario(1, 'Scenario')
+        pivot.adjust(1, 'sale', feb, Decimal('0.50'))
+        pivot.adjust(1, 'expense', feb, Decimal('0.30'))
+
+        self.assertEqual(
+            [(r['name'], r['columns'][-1]) for r in pivot.synthesis('All')], [
+                ('Sales', Decimal(15)),
+                ('Expenses', Decimal(3)),
+                ('A', Decimal(10)),
+                ('B', Decimal(2)),
+                ('All', Decimal(12)),
+                ('Scenario', Decimal('12.20')),
+                ])
+
+    def test_pivot_balance(self):
+        'Test running and minimum balance of the pivot'
+        from ..cashflow import Pivot, CashFlowReport
+
+        columns = CashFlowReport._get_date_columns(
+            datetime.date(2021, 1, 1), datetime.date(2021, 3, 31))
+        jan, feb, mar = (datetime.date(2021, m, 1) for m in [1, 2, 3])
+        pivot = Pivot(columns, 2)
+        pivot.add_source('sale', 'Sales', 1)
+        pivot.add_source('expense', 'Expenses', -1)
+        pivot.add('sale', 1, 'A', jan, Decimal(10))
+        pivot.add('expense', 2, 'B', feb, Decimal(25))
+        pivot.add('sale', 1, 'A', mar, Decimal(20))
+        pivot.set_opening(Decimal(5), 'Opening', 'Balance', 'Minimum')
+
+        self.assertEqual(
+            [(r['name'], r['columns']) for r in pivot.synthesis('Result')[3:]],
+            [
+                ('Opening', [Decimal(5), Decimal(15), Decimal(-10),
+                        Decimal(5)]),
+                ('Balance', [Decimal(15), Decimal(-10), Decimal(10),
+                        Decimal(10)]),
+                ('Minimum', [Decimal(5), Decimal(-10), Decimal(-10),
+                        Decimal(-10)]),
+                ])
+
+    def test_pivot_merge(self):
+        'Test merge of the pivots of each source'
+        from ..cashflow import Pivot, CashFlowReport
+
+        columns = CashFlowReport._get_date_columns(
+            datetime.date(2021, 1, 1), datetime.date(2021, 2, 28))
+        jan, feb = datetime.date(2021, 1, 1), datetime.date(2021, 2, 1)
+        pivot = Pivot(columns, 2)
+        pivot.add_source('sale', 'Sales', 1)
+        pivot.add_source('expense', 'Expenses', -1)
+        for source, sign, date, amount in [
+                ('sale', 1, jan, Decimal(10)),
+                ('expense', -1, feb, Decimal(4)),
+                ]:
+            other = Pivot(columns, 2)
+            other.add_source(source, source, sign)
+            other.add(source, 1, 'A', date, amount)
+            pivot.merge(other)
+
+        self.assertEqual(
+            [(r['name'], r['columns']) for r in pivot.synthesis('Result')], [
+                ('Sales', [Decimal(10), None, Decimal(10)]),
+                ('Expenses', [None, Decimal(4), Decimal(4)]),
+                ('Result', [Decimal(10), Decimal(-4), Decimal(6)]),
+                ])
+        self.assertEqual(pivot.summary('expense', 'category'), [{
+                    'category': 'A',
+                    'columns': [None, Decimal(4), Decimal(4)],
+                    'total': Decimal(4),
+                    }])
+
+    def test_formula(self):
+        'Test projection formula'
+        from ..formula import Formula, months_between
+
+        formula = Formula('unit_price * (1.1 if months >= 2 else 1)',
+            ['unit_price', 'months'])
+        self.assertEqual(formula.map([
+                    {'unit_price': Decimal(10), 'months': 0},
+                    {'unit_price': Decimal(10), 'months': 2},
+                    ]), [Decimal(10), Decimal('11.0')])
+        self.assertEqual(months_between(
+                datetime.date(2021, 11, 30), datetime.date(2022, 1, 1)), 2)
+        with self.assertRaises(NameError):
+            Formula('price * 2', ['unit_price'])
+        with self.assertRaises(Exception):
+            Formula('unit_price.__class__', ['unit_price'])(
+                unit_price=Decimal(1))
+
+    def test_profiler(self):
+        'Test profiler of the report phases'
+        from ..profiler import Profiler, phase
+
+        profiler = Profiler()
+        with phase('inactive'):
+            pass
+        with profiler.phase('outer'):
+            profiler.add(queries=2, rows=10)
+            with profiler.phase('inner'):
+                profiler.add(queries=1, rows=5)
+            # the queries of the other threads are not in the phase
+            thread = threading.Thread(target=profiler.add, args=(4, 20))
+            thread.start()
+            thread.join()
+
+        self.assertEqual(
+            [(m['name'], m['queries'], m['rows']) for m in profiler.phases],
+            [('inner', 1, 5), ('outer', 3, 15)])
+        self.assertEqual((profiler.queries, profiler.rows), (7, 35))
+
 
 def suite():
     suite = test_suite()